@@ -0,0 +1,151 @@
+import os
+import asyncio
+
+import numpy as np
+
+import exec_report_metrics as metrics
+from settings import (FFMPEG_BINARY, AUDIO_OPUS_BITRATE, AUDIO_VAD_FRAME_MS, AUDIO_VAD_THRESHOLD_DB,
+                      AUDIO_MAX_SILENCE_MS, AUDIO_VAD_PAD_MS)
+
+SAMPLE_RATE = 16000
+
+
+class AudioPrepError(RuntimeError):
+    """Raised when ffmpeg cannot decode or encode the audio."""
+
+
+async def _ffmpeg(args: list[str], stdin: bytes | None = None) -> bytes:
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, "-nostdin", "-hide_banner", "-loglevel", "error", *args,
+        stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out, err = await proc.communicate(stdin)
+    if proc.returncode != 0:
+        raise AudioPrepError(err.decode(errors="replace").strip() or f"ffmpeg exited with {proc.returncode}")
+    return out
+
+
+# === DECODE / ENCODE ===
+async def decode(audio: bytes | bytearray | str) -> np.ndarray:
+    """Any ffmpeg-readable input (bytes or a path) -> 16 kHz mono int16 samples."""
+    if isinstance(audio, str):
+        raw = await _ffmpeg(["-i", audio, "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"])
+    else:
+        raw = await _ffmpeg(["-i", "pipe:0", "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"],
+                            stdin=bytes(audio))
+    return np.frombuffer(raw, dtype=np.int16)
+
+
+async def encode(samples: np.ndarray) -> bytes:
+    """16 kHz mono int16 samples -> Ogg/Opus tuned for speech."""
+    return await _ffmpeg(
+        ["-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-i", "pipe:0",
+         "-c:a", "libopus", "-b:a", AUDIO_OPUS_BITRATE, "-application", "voip", "-f", "ogg", "pipe:1"],
+        stdin=samples.tobytes(),
+    )
+
+
+# === SILENCE TRIMMING ===
+def frame_rms(samples: np.ndarray, frame: int) -> np.ndarray:
+    """RMS level (0..1) of each whole `frame`-sample frame."""
+    n_frames = len(samples) // frame
+    frames = samples[:n_frames * frame].astype(np.float32).reshape(n_frames, frame) / 32768.0
+    return np.sqrt(np.mean(frames * frames, axis=1))
+
+
+def trim_silence(samples: np.ndarray, frame_ms: int = AUDIO_VAD_FRAME_MS,
+                 threshold_db: float = AUDIO_VAD_THRESHOLD_DB,
+                 max_silence_ms: int = AUDIO_MAX_SILENCE_MS, pad_ms: int = AUDIO_VAD_PAD_MS) -> np.ndarray:
+    """
+    Energy VAD over fixed frames. Leading/trailing silence is cut down to
+    `pad_ms`, and internal silences longer than `max_silence_ms` are shortened
+    to that length (half kept on each side). Returns the input unchanged if no
+    frame is loud enough to count as speech.
+    """
+    frame = SAMPLE_RATE * frame_ms // 1000
+    n_frames = len(samples) // frame
+    if n_frames == 0:
+        return samples
+
+    rms = frame_rms(samples, frame)
+    voiced = 20 * np.log10(np.maximum(rms, 1e-10)) > threshold_db
+    if not voiced.any():
+        return samples
+
+    voiced_idx = np.flatnonzero(voiced)
+    pad = pad_ms // frame_ms
+    keep = np.zeros(n_frames, dtype=bool)
+    keep[max(0, voiced_idx[0] - pad):min(n_frames, voiced_idx[-1] + pad + 1)] = True
+
+    # Silent runs between speech: keep max_silence/2 frames at each edge
+    gaps = np.diff(voiced_idx) - 1
+    half = max(1, max_silence_ms // frame_ms // 2)
+    for start, length in zip(voiced_idx[:-1][gaps > 2 * half] + 1, gaps[gaps > 2 * half]):
+        keep[start + half:start + length - half] = False
+
+    # Expand the frame mask to samples; the tail shorter than one frame follows the last frame
+    mask = np.repeat(keep, frame)
+    if len(samples) > len(mask):
+        mask = np.concatenate([mask, np.full(len(samples) - len(mask), keep[-1])])
+    return samples[mask]
+
+
+# === CHUNKING ===
+def split_at_silence(samples: np.ndarray, chunk_s: float, overlap_s: float,
+                     frame_ms: int = AUDIO_VAD_FRAME_MS) -> list[tuple[int, int]]:
+    """
+    Sample ranges covering `samples` in chunks of about `chunk_s` seconds.
+    Each cut is placed at the quietest frame in the last quarter of its chunk,
+    so cuts land in pauses rather than mid-word, and every chunk is widened by
+    `overlap_s` on both sides so nothing at a boundary is lost.
+    """
+    chunk = int(chunk_s * SAMPLE_RATE)
+    frame = SAMPLE_RATE * frame_ms // 1000
+    if chunk <= 0 or len(samples) <= chunk * 1.25:
+        return [(0, len(samples))]
+
+    rms = frame_rms(samples, frame)
+    search = max(1, chunk // 4 // frame)
+    cuts = [0]
+    while len(samples) - cuts[-1] > chunk * 1.25:
+        target = (cuts[-1] + chunk) // frame
+        lo = max(cuts[-1] // frame + 1, target - search)
+        cuts.append((lo + int(np.argmin(rms[lo:target + 1]))) * frame)
+    cuts.append(len(samples))
+
+    overlap = int(overlap_s * SAMPLE_RATE)
+    return [(max(0, start - overlap), min(len(samples), end + overlap)) for start, end in zip(cuts, cuts[1:])]
+
+
+async def chunk_audio(audio: bytes | bytearray | str, chunk_s: float, overlap_s: float,
+                      trim: bool = False) -> list[bytes]:
+    """Decode once, optionally trim silence, split at pauses and encode each chunk as Ogg/Opus."""
+    samples = await decode(audio)
+    if trim:
+        samples = await asyncio.to_thread(trim_silence, samples)
+    spans = await asyncio.to_thread(split_at_silence, samples, chunk_s, overlap_s)
+    return [await encode(samples[start:end]) for start, end in spans]
+
+
+# === PIPELINE ===
+async def preprocess(audio: bytes | bytearray | str) -> bytes:
+    """Decode, downmix/resample, trim silence and re-encode. Records the size and duration saved."""
+    with metrics.timed("audio_prep"):
+        size_in = os.path.getsize(audio) if isinstance(audio, str) else len(audio)
+
+        samples = await decode(audio)
+        trimmed = await asyncio.to_thread(trim_silence, samples)
+        encoded = await encode(trimmed)
+
+    ms_in = len(samples) * 1000 // SAMPLE_RATE
+    ms_out = len(trimmed) * 1000 // SAMPLE_RATE
+    metrics.incr("audio_prep.files")
+    metrics.incr("audio_prep.bytes_in", size_in)
+    metrics.incr("audio_prep.bytes_out", len(encoded))
+    metrics.incr("audio_prep.audio_ms_in", ms_in)
+    metrics.incr("audio_prep.audio_ms_out", ms_out)
+    print(f"🎚 Audio preprocessed: {size_in / 1024:.0f} KB -> {len(encoded) / 1024:.0f} KB, "
+          f"{ms_in / 1000:.1f}s -> {ms_out / 1000:.1f}s")
+    return encoded
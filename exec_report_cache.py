@@ -0,0 +1,143 @@
+import time
+import hashlib
+import unicodedata
+from collections import OrderedDict
+
+import exec_report_metrics as metrics
+from settings import init_db_pool
+
+# Run a Postgres TTL purge once every this many writes
+PURGE_EVERY = 500
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text so trivially different resends map to the same key."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(text.split())
+
+
+def content_key(*parts) -> str:
+    """SHA-256 over the given parts, separated so ('ab', 'c') != ('a', 'bc')."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+# === TWO-TIER CACHE ===
+# Every TwoTierCache registers here so /metrics can report hit rates
+caches: list["TwoTierCache"] = []
+
+
+def publish_cache_stats():
+    """Refresh each cache's size and hit rate as gauges (cache.<name>.size / .hit_rate)."""
+    for cache in caches:
+        stats = cache.stats()
+        metrics.set_gauge(f"cache.{cache.name}.size", stats["size"])
+        metrics.set_gauge(f"cache.{cache.name}.hit_rate", stats["hit_rate"])
+
+
+class TwoTierCache:
+    """
+    In-process LRU in front of a Postgres table with columns (cache_key, value, created_at).
+    Both tiers expire entries after `ttl` seconds. Values are strings.
+    Postgres failures are logged and treated as misses so the cache never breaks a handler.
+    """
+
+    def __init__(self, name: str, table: str, maxsize: int, ttl: float):
+        self.name = name
+        self.table = table
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._writes = 0
+        caches.append(self)
+
+    # --- memory tier ---
+    def _get_local(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            metrics.incr(f"cache.{self.name}.expired")
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_local(self, key: str, value: str):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            metrics.incr(f"cache.{self.name}.evicted")
+
+    # --- public API ---
+    async def get(self, key: str) -> str | None:
+        value = self._get_local(key)
+        if value is not None:
+            metrics.incr(f"cache.{self.name}.hit_memory")
+            return value
+
+        try:
+            pool = await init_db_pool()
+            async with pool.acquire() as conn:
+                value = await conn.fetchval(
+                    f"""
+                    SELECT value FROM {self.table}
+                    WHERE cache_key = $1
+                      AND created_at > NOW() - make_interval(secs => $2)
+                    """,
+                    key, self.ttl
+                )
+        except Exception as e:
+            print(f"⚠️ {self.name} cache read failed: {e}")
+            value = None
+
+        if value is None:
+            metrics.incr(f"cache.{self.name}.miss")
+            return None
+
+        metrics.incr(f"cache.{self.name}.hit_db")
+        self._set_local(key, value)
+        return value
+
+    async def set(self, key: str, value: str):
+        self._set_local(key, value)
+        try:
+            pool = await init_db_pool()
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    f"""
+                    INSERT INTO {self.table} (cache_key, value, created_at)
+                    VALUES ($1, $2, NOW())
+                    ON CONFLICT (cache_key) DO UPDATE SET
+                        value = EXCLUDED.value,
+                        created_at = EXCLUDED.created_at
+                    """,
+                    key, value
+                )
+                self._writes += 1
+                if self._writes % PURGE_EVERY == 0:
+                    await conn.execute(
+                        f"DELETE FROM {self.table} WHERE created_at < NOW() - make_interval(secs => $1)",
+                        self.ttl
+                    )
+        except Exception as e:
+            print(f"⚠️ {self.name} cache write failed: {e}")
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        hits = (metrics.counter(f"cache.{self.name}.hit_memory")
+                + metrics.counter(f"cache.{self.name}.hit_db"))
+        misses = metrics.counter(f"cache.{self.name}.miss")
+        return {
+            "size": len(self._entries),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
@@ -0,0 +1,89 @@
+import time
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import exec_report_metrics as metrics
+
+
+# === PER-CHAT ORDERED CONCURRENCY ===
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates from different chats in parallel (at most `max_running` at once)
+    while updates from the same chat run strictly one after another, in arrival order.
+
+    PTB's own semaphore (`max_pending`) bounds admitted updates, including ones
+    waiting behind their chat; `max_running` bounds handlers actually executing,
+    so a burst from one chat can't occupy every execution slot.
+    """
+
+    def __init__(self, max_running: int, max_pending: int):
+        super().__init__(max_concurrent_updates=max_pending)
+        self._running = asyncio.Semaphore(max_running)
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        self._chat_users: dict[int, int] = {}
+        self._waiting = 0
+        self._active = 0
+
+    @staticmethod
+    def _ordering_key(update: object) -> int | None:
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine):
+        key = self._ordering_key(update)
+        queued_at = time.perf_counter()
+        self._waiting += 1
+        self._report()
+
+        lock = None
+        if key is not None:
+            # FIFO lock per chat; acquired before any other await so arrival order is kept
+            lock = self._chat_locks.setdefault(key, asyncio.Lock())
+            self._chat_users[key] = self._chat_users.get(key, 0) + 1
+
+        started = False
+        try:
+            if lock is not None:
+                await lock.acquire()
+            try:
+                async with self._running:
+                    self._waiting -= 1
+                    self._active += 1
+                    started = True
+                    self._report()
+                    metrics.observe("updates.wait", time.perf_counter() - queued_at)
+                    try:
+                        await coroutine
+                    finally:
+                        self._active -= 1
+            finally:
+                if lock is not None:
+                    lock.release()
+        finally:
+            if not started:
+                self._waiting -= 1
+                coroutine.close()
+            if key is not None:
+                self._chat_users[key] -= 1
+                if not self._chat_users[key]:
+                    del self._chat_users[key]
+                    del self._chat_locks[key]
+            metrics.incr("updates.processed")
+            self._report()
+
+    def _report(self):
+        metrics.set_gauge("updates.queue_depth", self._waiting)
+        metrics.set_gauge("updates.running", self._active)
+        metrics.set_gauge("updates.chats_in_flight", len(self._chat_locks))
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
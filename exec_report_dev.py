@@ -1,20 +1,123 @@
 import os
+import time
+import asyncio
 import sqlite3
+import asyncpg
+from collections import OrderedDict
 from dotenv import load_dotenv
-from functools import lru_cache
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from settings import DEV_USER_IDS, get_db_connection, pool
+import exec_report_metrics as metrics
+import exec_report_queries as queries
+from exec_report_cache import publish_cache_stats
+from exec_report_media import media_store, is_media_key
+from exec_report_structured import parse_structured_sections
+from settings import (DATABASE_URL, DEV_USER_IDS, ROLE_CACHE_TTL, ROLE_CACHE_SIZE, ROLLUP_MAX_BULLETS,
+                      init_db_pool, pool)
 
 load_dotenv()
 
 # === USER ROLES ===
-@lru_cache(maxsize=256)
-def get_user_roles_cache(user_id: int) -> dict:
-    """Sync cache wrapper for roles per user_id (combined across orgs)."""
-    # Placeholder, real DB fetch is async
-    return {"admin": False, "executive": False, "user": False, "none": True}
+class RoleCache:
+    """
+    Async TTL cache of per-user, per-org role flags: {org_id: {"admin": bool, "executive": bool}}.
+    Concurrent misses for the same user share one query (single-flight).
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+        self._inflight: dict[int, asyncio.Future] = {}
+        # Bumped on invalidation so a load that started earlier can't store stale roles
+        self._epoch = 0
+        self._generation: dict[int, int] = {}
+
+    async def get(self, user_id: int) -> dict:
+        entry = self._entries.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            metrics.incr("roles.hit")
+            return entry[1]
+
+        inflight = self._inflight.get(user_id)
+        if inflight is not None:
+            metrics.incr("roles.shared_load")
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # The loader was cancelled, not us: load again ourselves
+                if not inflight.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                return await self.get(user_id)
+
+        metrics.incr("roles.miss")
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = future
+        generation = self._token(user_id)
+        try:
+            roles = await self._load(user_id)
+        except asyncio.CancelledError:
+            # Never leave waiters hanging on a future nobody will resolve
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        else:
+            future.set_result(roles)
+            if self._token(user_id) == generation:
+                self._store(user_id, roles)
+            return roles
+        finally:
+            self._inflight.pop(user_id, None)
+
+    async def _load(self, user_id: int) -> dict:
+        pool = await init_db_pool()
+        with metrics.timed("roles.load"):
+            async with pool.acquire() as conn:
+                rows = await queries.fetch(conn, "user_org_roles", user_id)
+        return {
+            row["org_id"]: {"admin": bool(row["admin"]), "executive": bool(row["executive"])}
+            for row in rows
+        }
+
+    def _store(self, user_id: int, roles: dict):
+        self._entries[user_id] = (time.monotonic() + self.ttl, roles)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _token(self, user_id: int) -> tuple[int, int]:
+        return self._epoch, self._generation.get(user_id, 0)
+
+    def invalidate(self, user_id: int | None = None):
+        if user_id is None:
+            self._entries.clear()
+            self._epoch += 1
+            return
+        self._entries.pop(user_id, None)
+        self._generation[user_id] = self._generation.get(user_id, 0) + 1
+
+    def stats(self) -> dict:
+        hits = metrics.counter("roles.hit") + metrics.counter("roles.shared_load")
+        misses = metrics.counter("roles.miss")
+        return {
+            "size": len(self._entries),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+
+role_cache = RoleCache(ttl=ROLE_CACHE_TTL, maxsize=ROLE_CACHE_SIZE)
+
+
+async def get_user_org_roles(user_id: int) -> dict:
+    """Return {org_id: {"admin": bool, "executive": bool}} for every org the user belongs to."""
+    return await role_cache.get(user_id)
 
 
 async def get_user_roles(user_id: int) -> dict:
@@ -22,21 +125,13 @@ async def get_user_roles(user_id: int) -> dict:
     Fetch a user's roles across organizations.
     Returns a dict with boolean flags: admin, executive, user, none.
     """
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT admin, executive
-            FROM user_orgs
-            WHERE user_id = $1
-            """,
-            user_id,
-        )
+    org_roles = await get_user_org_roles(user_id)
 
     roles = {"admin": False, "executive": False, "user": False, "none": True}
 
-    if rows:
-        roles["admin"] = any(row["admin"] for row in rows)
-        roles["executive"] = any(row["executive"] for row in rows)
+    if org_roles:
+        roles["admin"] = any(r["admin"] for r in org_roles.values())
+        roles["executive"] = any(r["executive"] for r in org_roles.values())
         roles["user"] = not (roles["admin"] or roles["executive"])
         roles["none"] = False
 
@@ -44,8 +139,73 @@ async def get_user_roles(user_id: int) -> dict:
 
 
 def clear_user_roles_cache(user_id: int = None):
-    """Clear cached roles for one user or all users."""
-    get_user_roles_cache.cache_clear()
+    """Clear cached roles for one user, or for all users when user_id is None (this process only)."""
+    role_cache.invalidate(user_id)
+
+
+# === CROSS-PROCESS INVALIDATION ===
+# With shard workers the changed user usually lives in another process, so role
+# changes are announced with NOTIFY and every process drops its cached copy.
+ROLE_CHANNEL = "role_cache_invalidate"
+
+
+async def roles_changed(user_id: int = None):
+    """Invalidate a user's cached roles here and in every other process."""
+    clear_user_roles_cache(user_id)
+    try:
+        pool = await init_db_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", ROLE_CHANNEL, "*" if user_id is None else str(user_id))
+    except Exception as e:
+        print(f"⚠️ Failed to broadcast role change for {user_id}: {e}")
+
+
+class RoleChangeListener:
+    """Dedicated LISTEN connection; reconnects if it drops."""
+
+    def __init__(self, channel: str = ROLE_CHANNEL):
+        self.channel = channel
+        self._task: asyncio.Task | None = None
+
+    def _on_notify(self, conn, pid, channel, payload):
+        clear_user_roles_cache(None if payload == "*" else int(payload))
+        metrics.incr("roles.remote_invalidations")
+
+    async def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(DATABASE_URL)
+                await conn.add_listener(self.channel, self._on_notify)
+                # Anything changed while we were not listening may be cached stale
+                clear_user_roles_cache()
+                while not conn.is_closed():
+                    await asyncio.sleep(5)
+                    await conn.execute("SELECT 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Role change listener lost its connection, reconnecting: {e}")
+                await asyncio.sleep(5)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+role_listener = RoleChangeListener()
 
 
 async def promote_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -83,7 +243,7 @@ async def promote_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "SELECT u.first_name, u.surname FROM users u WHERE u.user_id = $1", target_id
         )
 
-    clear_user_roles_cache(target_id)
+    await roles_changed(target_id)
 
     full_name = f"{row['first_name']} {row['surname']}" if row else f"User {target_id}"
     await update.message.reply_text(f"✅ {full_name} promoted to {role} in org {org_id}.")
@@ -124,13 +284,44 @@ async def demote_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "SELECT u.first_name, u.surname FROM users u WHERE u.user_id = $1", target_id
         )
 
-    clear_user_roles_cache(target_id)
+    await roles_changed(target_id)
 
     full_name = f"{row['first_name']} {row['surname']}" if row else f"User {target_id}"
     await update.message.reply_text(f"✅ {full_name} demoted from {role} in org {org_id}.")
 
 
 # === Developer-only reset command ===
+async def rebuild_current_rollups(conn, org_ids):
+    """
+    Re-fold this week's remaining updates into the orgs' daily and weekly rollups
+    after updates were deleted. Older periods are left as they were; /digest
+    only reads the current ones.
+    """
+    await conn.execute(
+        """
+        DELETE FROM org_rollups
+        WHERE org_id = ANY($1) AND period_start >= date_trunc('week', LOCALTIMESTAMP)::date
+        """,
+        org_ids
+    )
+    rows = await conn.fetch(
+        """
+        SELECT org_id, user_id, structured_text, timestamp
+        FROM updates
+        WHERE org_id = ANY($1) AND timestamp >= date_trunc('week', LOCALTIMESTAMP)
+        ORDER BY timestamp, id
+        """,
+        org_ids
+    )
+    for row in rows:
+        sections = parse_structured_sections(row["structured_text"])
+        await queries.execute(
+            conn, "rollup_upsert",
+            row["org_id"], sections["progress"], sections["incidents"], row["user_id"], row["timestamp"],
+            ROLLUP_MAX_BULLETS
+        )
+
+
 async def reset_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
@@ -151,28 +342,35 @@ async def reset_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     async with pool.acquire() as conn:
-        # Delete from user_orgs first (cascade optional, but explicit is safer)
-        await conn.execute(
-            "DELETE FROM user_orgs WHERE user_id = $1", target_id
-        )
+        async with conn.transaction():
+            # Delete from user_orgs first (cascade optional, but explicit is safer)
+            await conn.execute(
+                "DELETE FROM user_orgs WHERE user_id = $1", target_id
+            )
 
-        # Delete updates
-        await conn.execute(
-            "DELETE FROM updates WHERE user_id = $1", target_id
-        )
+            # Delete updates (remembering their images so the blobs can be released)
+            image_rows = await conn.fetch(
+                "DELETE FROM updates WHERE user_id = $1 RETURNING image_path, org_id", target_id
+            )
+            # ...and take them out of their orgs' digests
+            org_ids = sorted({r["org_id"] for r in image_rows})
+            if org_ids:
+                await rebuild_current_rollups(conn, org_ids)
 
-        # Delete visits (optional)
-        await conn.execute(
-            "DELETE FROM visits WHERE user_id = $1", target_id
-        )
+            # Delete visits (optional)
+            await conn.execute(
+                "DELETE FROM visits WHERE user_id = $1", target_id
+            )
 
-        # Delete user record
-        result = await conn.execute(
-            "DELETE FROM users WHERE user_id = $1", target_id
-        )
+            # Delete user record
+            result = await conn.execute(
+                "DELETE FROM users WHERE user_id = $1", target_id
+            )
+
+    await media_store.release([r["image_path"] for r in image_rows if is_media_key(r["image_path"])])
 
     # Clear cached roles
-    clear_user_roles_cache(target_id)
+    await roles_changed(target_id)
 
     if result.endswith("0"):
         await update.message.reply_text(f"ℹ️ No user with ID {target_id} was found in the database.")
@@ -181,5 +379,21 @@ async def reset_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"✅ User {target_id} has been reset. They’ll go through onboarding again at /start."
         )
 
+# === Developer-only metrics report ===
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/metrics [prefix] — dump in-process counters, gauges and timings."""
+    if update.effective_user.id not in DEV_USER_IDS:
+        await update.message.reply_text("🚫 You are not allowed to run this command.")
+        return
+
+    prefix = context.args[0] if context.args else ""
+    publish_cache_stats()
+    roles = role_cache.stats()
+    metrics.set_gauge("roles.size", roles["size"])
+    metrics.set_gauge("roles.hit_rate", roles["hit_rate"])
+    report = metrics.format_report(prefix)[:4000]  # Telegram caps messages at 4096 chars
+    await update.message.reply_text(f"📊 Metrics\n\n{report}")
+
+
 def main():
     pass
\ No newline at end of file
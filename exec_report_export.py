@@ -0,0 +1,99 @@
+import os
+import gzip
+import asyncio
+import tempfile
+
+import exec_report_metrics as metrics
+from settings import EXPORT_CHUNK_ROWS, EXPORT_TIMEOUT, EXPORT_DIR, init_db_pool
+
+# One row per update with its author and image references, oldest first
+EXPORT_QUERY = """
+    SELECT upd.id, upd.timestamp, upd.user_id, u.username, u.first_name, u.surname,
+           upd.original_text, upd.structured_text, upd.image_path, upd.image_file_id
+    FROM updates upd
+    LEFT JOIN users u ON u.user_id = upd.user_id
+    WHERE upd.org_id = $1
+    ORDER BY upd.timestamp, upd.id
+"""
+
+EXPORT_FORMATS = ("csv", "parquet")
+
+
+class ExportError(RuntimeError):
+    """Raised when an export cannot be produced (e.g. a missing optional dependency)."""
+
+
+# === WRITERS ===
+async def export_csv(org_id: int, path: str) -> int:
+    """
+    Stream the org's updates with COPY ... TO STDOUT straight into a gzip file.
+    Postgres formats the CSV; only one COPY chunk is in memory at a time.
+    Returns the compressed size in bytes.
+    """
+    pool = await init_db_pool()
+    with gzip.open(path, "wb") as out:
+        async def write(chunk: bytes):
+            await asyncio.to_thread(out.write, chunk)
+
+        async with pool.acquire() as conn:
+            await conn.copy_from_query(EXPORT_QUERY, org_id, output=write, format="csv",
+                                       header=True, timeout=EXPORT_TIMEOUT)
+    return os.path.getsize(path)
+
+
+async def export_parquet(org_id: int, path: str) -> int:
+    """
+    Walk the org's updates with a server-side cursor, EXPORT_CHUNK_ROWS at a
+    time, writing each chunk as a Parquet row group. Returns the file size in bytes.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ExportError("Parquet export needs pyarrow installed (pip install pyarrow)") from e
+
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("timestamp", pa.timestamp("us")),
+        ("user_id", pa.int64()),
+        ("username", pa.string()),
+        ("first_name", pa.string()),
+        ("surname", pa.string()),
+        ("original_text", pa.string()),
+        ("structured_text", pa.string()),
+        ("image_path", pa.string()),
+        ("image_file_id", pa.string()),
+    ])
+
+    pool = await init_db_pool()
+    writer = pq.ParquetWriter(path, schema, compression="zstd")
+    try:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(EXPORT_QUERY, org_id)
+                while True:
+                    rows = await cursor.fetch(EXPORT_CHUNK_ROWS, timeout=EXPORT_TIMEOUT)
+                    if not rows:
+                        break
+                    columns = {name: [row[name] for row in rows] for name in schema.names}
+                    table = pa.Table.from_pydict(columns, schema=schema)
+                    await asyncio.to_thread(writer.write_table, table)
+                    metrics.incr("export.rows", len(rows))
+    finally:
+        writer.close()
+    return os.path.getsize(path)
+
+
+async def export_org_updates(org_id: int, fmt: str) -> str:
+    """Write the export to a temp file and return its path. The caller deletes it."""
+    suffix = ".csv.gz" if fmt == "csv" else ".parquet"
+    fd, path = tempfile.mkstemp(prefix=f"export-org{org_id}-", suffix=suffix, dir=EXPORT_DIR)
+    os.close(fd)
+    try:
+        with metrics.timed(f"export.{fmt}"):
+            size = await (export_csv(org_id, path) if fmt == "csv" else export_parquet(org_id, path))
+    except BaseException:
+        os.remove(path)
+        raise
+    metrics.incr("export.bytes", size)
+    return path
@@ -0,0 +1,108 @@
+import os
+import asyncio
+import tempfile
+
+import exec_report_metrics as metrics
+from settings import MEDIA_SPILL_THRESHOLD, MEDIA_MEMORY_CAP, MEDIA_SPILL_DIR
+
+
+# === MEMORY BUDGET ===
+class MemoryBudget:
+    """Bytes of incoming media currently held in memory, capped at `cap`."""
+
+    def __init__(self, cap: int):
+        self.cap = cap
+        self.used = 0
+
+    def try_reserve(self, size: int) -> bool:
+        if self.used + size > self.cap:
+            return False
+        self.used += size
+        metrics.set_gauge("ingest.memory_bytes", self.used)
+        return True
+
+    def release(self, size: int):
+        self.used = max(0, self.used - size)
+        metrics.set_gauge("ingest.memory_bytes", self.used)
+
+
+memory_budget = MemoryBudget(MEDIA_MEMORY_CAP)
+
+
+# === INGESTED MEDIA ===
+class IngestedMedia:
+    """
+    A downloaded Telegram file, held either in memory (`data`) or in a temp
+    file (`path`). Use as an async context manager, or call close(), so the
+    memory reservation or temp file is always given back.
+    """
+
+    def __init__(self, data: bytearray | None = None, path: str | None = None, reserved: int = 0):
+        self.data = data
+        self.path = path
+        self._reserved = reserved
+
+    @property
+    def in_memory(self) -> bool:
+        return self.data is not None
+
+    @property
+    def source(self) -> bytearray | str:
+        """What the transcription client accepts: the raw buffer or a local path."""
+        return self.data if self.in_memory else self.path
+
+    async def read(self) -> bytes:
+        if self.in_memory:
+            return bytes(self.data)
+        with open(self.path, "rb") as f:
+            return await asyncio.to_thread(f.read)
+
+    def close(self):
+        if self._reserved:
+            memory_budget.release(self._reserved)
+            self._reserved = 0
+        self.data = None
+        if self.path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"⚠️ Failed to remove spilled media {self.path}: {e}")
+            self.path = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+async def ingest(file, size: int | None = None, suffix: str = "") -> IngestedMedia:
+    """
+    Download a telegram.File. Small files land in a bytearray with no disk I/O;
+    large ones, or any file that would push in-flight media past the memory cap,
+    are spilled to a temp file. `size` is the file_size Telegram reported, if any.
+    """
+    expected = size or file.file_size or MEDIA_SPILL_THRESHOLD
+
+    if expected <= MEDIA_SPILL_THRESHOLD and memory_budget.try_reserve(expected):
+        try:
+            data = await file.download_as_bytearray()
+        except BaseException:
+            memory_budget.release(expected)
+            raise
+        metrics.incr("ingest.in_memory")
+        metrics.incr("ingest.bytes_in_memory", len(data))
+        return IngestedMedia(data=data, reserved=expected)
+
+    fd, path = tempfile.mkstemp(prefix="ingest-", suffix=suffix, dir=MEDIA_SPILL_DIR)
+    os.close(fd)
+    try:
+        await file.download_to_drive(path)
+    except BaseException:
+        os.remove(path)
+        raise
+    metrics.incr("ingest.spilled")
+    metrics.incr("ingest.bytes_spilled", os.path.getsize(path))
+    return IngestedMedia(path=path)
@@ -0,0 +1,228 @@
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import google.generativeai as genai
+
+import exec_report_metrics as metrics
+from settings import (GEMINI_API_KEY, GEMINI_MAX_CONCURRENCY, GEMINI_TIMEOUT,
+                      GEMINI_BATCH_WINDOW_MS, GEMINI_BATCH_MAX_ITEMS,
+                      STRUCTURED_CACHE_SIZE, STRUCTURED_CACHE_TTL)
+from exec_report_cache import TwoTierCache, content_key, normalize_text
+
+# === SETUP GEMINI ===
+genai.configure(api_key=GEMINI_API_KEY)
+model = genai.GenerativeModel("gemini-2.5-flash")
+
+# Dedicated pool so slow Gemini calls never borrow the loop's default executor
+_gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY, thread_name_prefix="gemini")
+_gemini_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# Bump whenever build_prompt changes so cached output from the old prompt is ignored
+PROMPT_VERSION = 1
+
+structured_cache = TwoTierCache(
+    "structured", table="structured_cache",
+    maxsize=STRUCTURED_CACHE_SIZE, ttl=STRUCTURED_CACHE_TTL
+)
+
+
+# === PROMPT ===
+def prompt_date() -> str:
+    return datetime.now().strftime("%d %b %Y")
+
+
+def _template(today: str) -> str:
+    return (
+        "Limit each section to no more than 4 bullet points and each point to 9 words or less"
+        "Format your response in HTML suitable for Telegram's HTML parse mode. "
+        "Follow this exact template:\n\n"
+        f"<b>Date:</b> {today}\n\n"
+        "<b>Progress:</b>\n"
+        "• [Concise bullet point 1]\n"
+        "• [Concise bullet point 2]\n"
+        "• [Concise bullet point 3]\n"
+        "• [etc., up to 4 points]\n\n"
+        "<b>Incidence/Delay:</b>\n"
+        "• [Concise bullet point 1]\n"
+        "• [etc., or '• None.' if no issues]\n\n"
+    )
+
+
+def build_prompt(text: str) -> str:
+    return (
+        "You are a helpful assistant that structures work updates for busy executives. "
+        + _template(prompt_date()) +
+        "Ensure the response is clear, concise, and quick to read. Use no extra commentary.\n\n"
+        f"Text: {text}"
+    )
+
+
+def build_batch_prompt(texts: list[str]) -> str:
+    """One prompt for several updates; each answer must come back under its own ITEM marker."""
+    items = "\n\n".join(
+        f"<<<ITEM {i}>>>\n{text}\n<<<END {i}>>>" for i, text in enumerate(texts, start=1)
+    )
+    return (
+        "You are a helpful assistant that structures work updates for busy executives. "
+        f"You will receive {len(texts)} independent updates, each between <<<ITEM n>>> and <<<END n>>>. "
+        "Structure each one on its own; never mix content between items. "
+        + _template(prompt_date()) +
+        f"Return exactly {len(texts)} blocks in input order. Start each block with a line containing only "
+        "=== ITEM n === (n is the item number) followed by that item's structured update. "
+        "Write nothing before the first block or after the last one.\n\n"
+        f"{items}"
+    )
+
+
+_ITEM_MARKER = re.compile(r"^=== ITEM (\d+) ===[ \t]*$", re.MULTILINE)
+
+
+def parse_batch_response(raw: str, count: int) -> dict[int, str]:
+    """Split a batch answer into {item_index: structured_text}. Missing or empty items are left out."""
+    markers = list(_ITEM_MARKER.finditer(raw))
+    results = {}
+    for marker, following in zip(markers, markers[1:] + [None]):
+        index = int(marker.group(1)) - 1
+        end = following.start() if following else len(raw)
+        body = raw[marker.end():end].strip()
+        if 0 <= index < count and body and index not in results:
+            results[index] = body
+    return results
+
+
+# === STRUCTURE TEXT ===
+def structure_text(text: str) -> str:
+    """Blocking Gemini call. Never await this from a handler directly."""
+    return _generate(build_prompt(text))
+
+
+def _generate(prompt: str) -> str:
+    # Client-side timeout so the executor thread itself gives up, not just the awaiting coroutine
+    response = model.generate_content(prompt, request_options={"timeout": GEMINI_TIMEOUT})
+    return response.text.strip()
+
+
+async def _generate_async(prompt: str) -> str:
+    """
+    Run one Gemini call on the dedicated executor, bounded and timed out.
+    The slot is held until the executor thread is actually free, so a timed-out
+    call never lets a new one queue behind a still-busy thread.
+    """
+    loop = asyncio.get_running_loop()
+    await _gemini_slots.acquire()
+    try:
+        future = loop.run_in_executor(_gemini_executor, _generate, prompt)
+    except BaseException:
+        _gemini_slots.release()
+        raise
+    future.add_done_callback(lambda _: _gemini_slots.release())
+    with metrics.timed("gemini.call"):
+        return await asyncio.wait_for(asyncio.shield(future), timeout=GEMINI_TIMEOUT)
+
+
+# === MICRO-BATCHING ===
+class StructuringBatcher:
+    """
+    Collects texts for up to `window` seconds (or until `max_items` are waiting)
+    and structures them with a single multi-item Gemini call. Items the model
+    answers badly fall back to individual calls; if the batched call itself
+    fails or times out, every waiter gets that error, so nobody waits past
+    GEMINI_TIMEOUT twice.
+    """
+
+    def __init__(self, window: float, max_items: int):
+        self.window = window
+        self.max_items = max_items
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, text: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[str, asyncio.Future]]):
+        metrics.incr("gemini.batch.items", len(batch))
+        results: dict[int, str] = {}
+
+        if len(batch) > 1:
+            metrics.incr("gemini.batch.calls")
+            try:
+                raw = await _generate_async(build_batch_prompt([text for text, _ in batch]))
+            except Exception as e:
+                print(f"⚠️ Batched structuring failed for {len(batch)} items: {e!r}")
+                metrics.incr("gemini.batch.failures")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            results = parse_batch_response(raw, len(batch))
+
+        missing = [i for i in range(len(batch)) if i not in results]
+        if len(batch) > 1 and missing:
+            metrics.incr("gemini.batch.fallback_items", len(missing))
+
+        async def single(index: int):
+            text, future = batch[index]
+            try:
+                results[index] = await _generate_async(build_prompt(text))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+        await asyncio.gather(*(single(i) for i in missing))
+
+        for index, (_, future) in enumerate(batch):
+            if index in results and not future.done():
+                future.set_result(results[index])
+
+
+batcher = StructuringBatcher(GEMINI_BATCH_WINDOW_MS / 1000, GEMINI_BATCH_MAX_ITEMS) if GEMINI_BATCH_WINDOW_MS > 0 else None
+
+
+def structured_cache_key(text: str) -> str:
+    """Content address of an update: normalized text + prompt version + the date baked into the prompt."""
+    return content_key("structured", PROMPT_VERSION, prompt_date(), normalize_text(text))
+
+
+async def structure_text_async(text: str) -> str:
+    """
+    Structure text without blocking the event loop.
+    Repeated inputs are served from structured_cache. Otherwise the text goes
+    through the micro-batcher when GEMINI_BATCH_WINDOW_MS is set, or straight to
+    Gemini; at most GEMINI_MAX_CONCURRENCY calls run at once, each capped at
+    GEMINI_TIMEOUT seconds. Raises asyncio.TimeoutError if Gemini does not answer in time.
+    """
+    key = structured_cache_key(text)
+    cached = await structured_cache.get(key)
+    if cached is not None:
+        return cached
+
+    if batcher is not None:
+        structured = await batcher.submit(text)
+    else:
+        structured = await _generate_async(build_prompt(text))
+
+    await structured_cache.set(key, structured)
+    return structured
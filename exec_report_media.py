@@ -0,0 +1,219 @@
+import os
+import asyncio
+import hashlib
+import tempfile
+from collections import Counter
+
+import exec_report_metrics as metrics
+from settings import (MEDIA_BACKEND, MEDIA_ROOT, MEDIA_S3_BUCKET, MEDIA_S3_ENDPOINT_URL,
+                      MEDIA_S3_PREFIX, MEDIA_S3_REGION, init_db_pool)
+
+# updates.image_path holds "sha256:<hex>" for stored blobs; anything else is a legacy file path
+MEDIA_KEY_PREFIX = "sha256:"
+
+
+def is_media_key(value: str | None) -> bool:
+    return bool(value) and value.startswith(MEDIA_KEY_PREFIX)
+
+
+def shard_path(digest: str) -> str:
+    """ab/cd/abcd… — two directory levels keep every directory small."""
+    return f"{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+# === BACKENDS ===
+class LocalMediaBackend:
+    """Blobs on the local filesystem under `root`, written atomically."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, shard_path(digest))
+
+    def _write(self, digest: str, data: bytes):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _read(self, digest: str) -> bytes:
+        with open(self._path(digest), "rb") as f:
+            return f.read()
+
+    def _delete(self, digest: str):
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    async def exists(self, digest: str) -> bool:
+        return await asyncio.to_thread(os.path.exists, self._path(digest))
+
+    async def write(self, digest: str, data: bytes):
+        await asyncio.to_thread(self._write, digest, data)
+
+    async def read(self, digest: str) -> bytes:
+        return await asyncio.to_thread(self._read, digest)
+
+    async def delete(self, digest: str):
+        await asyncio.to_thread(self._delete, digest)
+
+
+class S3MediaBackend:
+    """
+    Blobs in an S3-compatible bucket. `endpoint_url` points at MinIO or any
+    local stand-in; credentials come from the usual AWS environment variables.
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str | None = None, region: str | None = None):
+        try:
+            import boto3
+        except ImportError as e:
+            raise RuntimeError("MEDIA_BACKEND=s3 needs boto3 installed (pip install boto3)") from e
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+
+    def _key(self, digest: str) -> str:
+        return f"{self.prefix}/{shard_path(digest)}" if self.prefix else shard_path(digest)
+
+    def _exists(self, digest: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(digest))
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    async def exists(self, digest: str) -> bool:
+        return await asyncio.to_thread(self._exists, digest)
+
+    async def write(self, digest: str, data: bytes):
+        await asyncio.to_thread(self.client.put_object, Bucket=self.bucket, Key=self._key(digest), Body=data)
+
+    async def read(self, digest: str) -> bytes:
+        response = await asyncio.to_thread(self.client.get_object, Bucket=self.bucket, Key=self._key(digest))
+        return await asyncio.to_thread(response["Body"].read)
+
+    async def delete(self, digest: str):
+        await asyncio.to_thread(self.client.delete_object, Bucket=self.bucket, Key=self._key(digest))
+
+
+# === MEDIA STORE ===
+class MediaStore:
+    """
+    Content-addressed, reference-counted blob store. Identical bytes are stored
+    once; media_blobs.refcount tracks how many updates point at each blob, and
+    the blob is only deleted when the last reference is released. Puts and
+    releases of the same digest are serialized with a transaction-scoped
+    advisory lock so a concurrent put can never lose its blob.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def put(self, data: bytes) -> str:
+        """
+        Store bytes (if new) and take a reference. Returns the media key.
+        The reference is claimed first, under the lock, and the blob is written
+        afterwards with no connection held: once claimed, no release can reach
+        zero and delete the blob underneath us, so slow uploads never pin the pool.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        pool = await init_db_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", digest)
+                refcount = await conn.fetchval(
+                    """
+                    INSERT INTO media_blobs (sha256, refcount, size)
+                    VALUES ($1, 1, $2)
+                    ON CONFLICT (sha256) DO UPDATE SET refcount = media_blobs.refcount + 1
+                    RETURNING refcount
+                    """,
+                    digest, len(data)
+                )
+
+        key = MEDIA_KEY_PREFIX + digest
+        try:
+            if refcount == 1 or not await self.backend.exists(digest):
+                await self.backend.write(digest, data)
+                metrics.incr("media.blobs_written")
+            else:
+                metrics.incr("media.dedup_hits")
+        except BaseException:
+            await self.release([key])
+            raise
+        return key
+
+    async def get(self, key: str) -> bytes:
+        return await self.backend.read(key[len(MEDIA_KEY_PREFIX):])
+
+    async def release(self, keys: list[str]) -> tuple[int, int]:
+        """
+        Drop one reference per key. Returns (blobs deleted, deletions failed).
+        All refcounts move in one transaction; blobs that reached zero are
+        deleted after it commits, so no connection is held during backend I/O.
+        """
+        if not keys:
+            return 0, 0
+        counts = Counter(key[len(MEDIA_KEY_PREFIX):] for key in keys)
+        # Sorted (unnest keeps array order), so two releases sharing blobs lock in the same order
+        digests = sorted(counts)
+        pool = await init_db_pool()
+        try:
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(
+                        "SELECT pg_advisory_xact_lock(hashtext(d)) FROM unnest($1::text[]) AS d",
+                        digests
+                    )
+                    await conn.execute(
+                        """
+                        UPDATE media_blobs m SET refcount = m.refcount - d.n
+                        FROM unnest($1::text[], $2::int[]) AS d(sha256, n)
+                        WHERE m.sha256 = d.sha256
+                        """,
+                        digests, [counts[d] for d in digests]
+                    )
+                    unreferenced = await conn.fetch(
+                        "DELETE FROM media_blobs WHERE sha256 = ANY($1::text[]) AND refcount <= 0 RETURNING sha256",
+                        digests
+                    )
+        except Exception as e:
+            print(f"⚠️ Failed to release {len(digests)} media blobs: {e}")
+            return 0, len(digests)
+
+        removed = failed = 0
+        for row in unreferenced:
+            digest = row["sha256"]
+            try:
+                # A put may have claimed the digest again since we committed; its blob must stay
+                async with pool.acquire() as conn:
+                    if await conn.fetchval("SELECT 1 FROM media_blobs WHERE sha256 = $1", digest):
+                        continue
+                await self.backend.delete(digest)
+                removed += 1
+            except Exception as e:
+                print(f"⚠️ Failed to delete media {digest}: {e}")
+                failed += 1
+        return removed, failed
+
+
+def make_backend():
+    if MEDIA_BACKEND == "s3":
+        return S3MediaBackend(MEDIA_S3_BUCKET, MEDIA_S3_PREFIX, MEDIA_S3_ENDPOINT_URL, MEDIA_S3_REGION)
+    return LocalMediaBackend(MEDIA_ROOT)
+
+
+media_store = MediaStore(make_backend())
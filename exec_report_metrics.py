@@ -0,0 +1,101 @@
+import time
+from collections import defaultdict, deque
+
+# === IN-PROCESS METRICS ===
+# Counters and gauges are plain numbers; timings keep the most recent samples per name.
+TIMING_SAMPLES = 2048
+
+_counters: dict[str, int] = defaultdict(int)
+_gauges: dict[str, float] = {}
+_timings: dict[str, deque] = defaultdict(lambda: deque(maxlen=TIMING_SAMPLES))
+_timing_totals: dict[str, list] = defaultdict(lambda: [0, 0.0])  # [count, total seconds]
+
+
+def incr(name: str, value: int = 1):
+    _counters[name] += value
+
+
+def set_gauge(name: str, value: float):
+    _gauges[name] = value
+
+
+def observe(name: str, seconds: float):
+    """Record one timing sample in seconds."""
+    _timings[name].append(seconds)
+    totals = _timing_totals[name]
+    totals[0] += 1
+    totals[1] += seconds
+
+
+class timed:
+    """Context manager that records elapsed time under `name`."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def percentile(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def counter(name: str) -> int:
+    return _counters.get(name, 0)
+
+
+def timing_summary(name: str) -> dict:
+    samples = list(_timings.get(name, ()))
+    count, total = _timing_totals.get(name, (0, 0.0))
+    return {
+        "count": count,
+        "avg_ms": (total / count * 1000) if count else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+    }
+
+
+def snapshot() -> dict:
+    return {
+        "counters": dict(_counters),
+        "gauges": dict(_gauges),
+        "timings": {name: timing_summary(name) for name in list(_timings)},
+    }
+
+
+def format_report(prefix: str = "") -> str:
+    """Plain-text report for the /metrics command, optionally filtered by name prefix."""
+    snap = snapshot()
+    lines = []
+
+    counters = {k: v for k, v in sorted(snap["counters"].items()) if k.startswith(prefix)}
+    if counters:
+        lines.append("Counters:")
+        lines += [f"  {k} = {v}" for k, v in counters.items()]
+
+    gauges = {k: v for k, v in sorted(snap["gauges"].items()) if k.startswith(prefix)}
+    if gauges:
+        lines.append("Gauges:")
+        lines += [f"  {k} = {v:g}" for k, v in gauges.items()]
+
+    timings = {k: v for k, v in sorted(snap["timings"].items()) if k.startswith(prefix)}
+    if timings:
+        lines.append("Timings (ms):")
+        lines += [
+            f"  {k}: n={t['count']} avg={t['avg_ms']:.1f} p50={t['p50_ms']:.1f} "
+            f"p95={t['p95_ms']:.1f} max={t['max_ms']:.1f}"
+            for k, t in timings.items()
+        ]
+
+    return "\n".join(lines) or "No metrics recorded yet."
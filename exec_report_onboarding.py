@@ -5,6 +5,9 @@ from telegram.ext import (
     ConversationHandler, CallbackQueryHandler, ContextTypes
 )
 
+from exec_report_dev import roles_changed
+from settings import pool
+
 DB_PATH = "work_updates.db"
 
 # States for onboarding
@@ -176,7 +179,7 @@ async def org_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return "retry_org_name"
 
-    # === Asyncpg connection pool (assumes `pool` is global or passed in context) ===
+    # === Asyncpg connection pool (shared settings.pool) ===
     async with pool.acquire() as conn:
         if choice == "create":
             try:
@@ -251,6 +254,9 @@ async def org_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id, username, first_name, surname
         )
 
+    # New org membership changes this user's roles
+    await roles_changed(user_id)
+
     return "onboarding_complete"
 
 # === Cancel flow ===
@@ -0,0 +1,177 @@
+import time
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import exec_report_metrics as metrics
+from settings import (OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+                      OUTBOUND_GROUP_RATE_PER_MIN, OUTBOUND_MAX_RETRIES, WORKER_PROCESSES)
+
+# === PRIORITIES ===
+INTERACTIVE, BULK = 0, 1
+# Message shortcuts (reply_text etc.) can't pass rate_limit_args, so priority rides on a context var
+_priority: ContextVar[int] = ContextVar("outbound_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def bulk_sends():
+    """Everything sent inside this block yields to interactive replies."""
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+# === TOKEN BUCKET ===
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, cost: float = 1) -> float:
+        """Seconds until `cost` tokens are available (0 if available now)."""
+        self._refill()
+        # A cost above capacity can never be met in one go; it waits for a full bucket and goes into debt
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            return 0.0
+        return max(self.updated - time.monotonic(), 0.0) + (cost - self.tokens) / self.rate
+
+    def take(self, cost: float = 1):
+        self._refill()
+        self.tokens -= cost
+
+    def pause(self, seconds: float):
+        """Empty the bucket and hold refills for `seconds` (Telegram's retry_after)."""
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+# === OUTBOUND SCHEDULER ===
+class OutboundScheduler(BaseRateLimiter):
+    """
+    PTB rate limiter, so every Bot API call the app makes passes through it.
+    Sends to a chat (anything with chat_id) take a token per message (one per
+    item for sendMediaGroup) from the global bucket and from that chat's bucket
+    (private chats: OUTBOUND_CHAT_RATE/s with a small burst; groups:
+    OUTBOUND_GROUP_RATE_PER_MIN). Bulk sends wait while an interactive send is
+    held up by the global bucket; one only waiting on its own chat's bucket does
+    not stall them. A RetryAfter from Telegram pauses the affected bucket and
+    the request is retried.
+    """
+
+    MAX_CHAT_BUCKETS = 4096
+
+    def __init__(self):
+        # With shard workers each process gets an equal slice of the global limit
+        global_rate = OUTBOUND_GLOBAL_RATE / max(1, WORKER_PROCESSES)
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: dict[int, TokenBucket] = {}
+        self._waiting = 0
+        self._interactive_waiting = 0
+        self._interactive_idle = asyncio.Event()
+        self._interactive_idle.set()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle()}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                bucket = TokenBucket(OUTBOUND_GROUP_RATE_PER_MIN / 60, OUTBOUND_CHAT_BURST)
+            else:
+                bucket = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _contend(self, delta: int):
+        """Track interactive sends waiting on the global bucket; bulk sends yield while any are."""
+        self._interactive_waiting += delta
+        if self._interactive_waiting:
+            self._interactive_idle.clear()
+        else:
+            self._interactive_idle.set()
+        self._report()
+
+    async def _acquire(self, chat_id, priority: int, cost: int = 1):
+        started = time.monotonic()
+        self._waiting += 1
+        self._report()
+        contending = False
+        try:
+            bucket = self._chat_bucket(chat_id)
+            while True:
+                if priority == BULK and self._interactive_waiting:
+                    await self._interactive_idle.wait()
+                    continue
+                chat_wait = bucket.delay(cost)
+                global_wait = self._global.delay(cost)
+                if priority == INTERACTIVE and contending != (chat_wait <= 0 < global_wait):
+                    contending = not contending
+                    self._contend(1 if contending else -1)
+                wait = max(global_wait, chat_wait)
+                if wait <= 0:
+                    self._global.take(cost)
+                    bucket.take(cost)
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            self._waiting -= 1
+            if contending:
+                self._contend(-1)
+            throttled = time.monotonic() - started
+            metrics.observe("outbound.throttle", throttled)
+            self._report()
+
+    def _report(self):
+        metrics.set_gauge("outbound.queue_length", self._waiting)
+        metrics.set_gauge("outbound.interactive_waiting", self._interactive_waiting)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = _priority.get()
+        if isinstance(rate_limit_args, dict):
+            priority = rate_limit_args.get("priority", priority)
+        chat_id = data.get("chat_id")
+        # Telegram counts every item of an album as a message
+        cost = max(1, len(data.get("media") or ())) if endpoint == "sendMediaGroup" else 1
+
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            if chat_id is not None:
+                await self._acquire(chat_id, priority, cost)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                metrics.incr("outbound.retry_after")
+                metrics.incr(f"outbound.{'bulk' if priority == BULK else 'interactive'}_retries")
+                print(f"⚠️ Telegram flood control on {endpoint}: retrying in {delay:.0f}s")
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(delay)
+                else:
+                    await asyncio.sleep(delay)
@@ -0,0 +1,145 @@
+import time
+import asyncio
+
+import asyncpg
+
+import exec_report_metrics as metrics
+
+# Upper bounds (ms) of the acquire-wait histogram buckets
+ACQUIRE_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)
+
+
+class _Acquire:
+    """`async with pool.acquire() as conn:` — times the wait and keeps gauges current."""
+
+    def __init__(self, owner: "InstrumentedPool", timeout: float | None):
+        self.owner = owner
+        self.timeout = timeout
+        self.conn = None
+        self.gated = False
+
+    async def __aenter__(self):
+        owner = self.owner
+        start = time.perf_counter()
+        owner._waiting += 1
+        try:
+            if owner._slots is not None:
+                await owner._slots.acquire()
+                self.gated = True
+            self.conn = await owner._pool.acquire(timeout=self.timeout)
+        except BaseException:
+            if self.gated:
+                owner._slots.release()
+            raise
+        finally:
+            owner._waiting -= 1
+        owner._record_acquire(time.perf_counter() - start)
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        try:
+            await self.owner._pool.release(self.conn)
+        finally:
+            if self.gated:
+                self.owner._slots.release()
+            self.owner._report()
+
+
+# === INSTRUMENTED POOL ===
+class InstrumentedPool:
+    """
+    Wraps an asyncpg pool and records acquire-wait timings and histogram
+    buckets, in-use/idle/waiting gauges, and a warning when a wait exceeds
+    `warn_ms`.
+
+    Adaptive mode: the asyncpg pool is created with `adaptive_max` connections
+    but handlers may only hold `max_size` at once. After `adaptive_streak`
+    slow acquires in a row, that limit grows by one, up to `adaptive_max`.
+    """
+
+    def __init__(self, dsn: str, min_size: int, max_size: int, statement_cache_size: int,
+                 max_inactive_lifetime: float, command_timeout: float | None, warn_ms: float,
+                 adaptive: bool = False, adaptive_max: int = 0, adaptive_streak: int = 5, init=None):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.max_inactive_lifetime = max_inactive_lifetime
+        self.command_timeout = command_timeout
+        self.warn_ms = warn_ms
+        self.adaptive = adaptive and adaptive_max > max_size
+        self.adaptive_max = adaptive_max
+        self.adaptive_streak = adaptive_streak
+        self.init = init
+        self.limit = max_size
+        self._pool: asyncpg.Pool | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._waiting = 0
+        self._slow_streak = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._pool is not None
+
+    async def connect(self):
+        self._pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.adaptive_max if self.adaptive else self.max_size,
+            statement_cache_size=self.statement_cache_size,
+            max_inactive_connection_lifetime=self.max_inactive_lifetime,
+            command_timeout=self.command_timeout,
+            init=self.init,
+        )
+        if self.adaptive:
+            self._slots = asyncio.Semaphore(self.max_size)
+        self._report()
+
+    def acquire(self, *, timeout: float | None = None) -> _Acquire:
+        return _Acquire(self, timeout)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def __getattr__(self, name):
+        # pool.execute / pool.fetch etc. go straight to asyncpg (untimed)
+        inner = self.__dict__.get("_pool")
+        if inner is None or name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(inner, name)
+
+    def _record_acquire(self, waited: float):
+        waited_ms = waited * 1000
+        metrics.observe("db.acquire_wait", waited)
+        bucket = next((f"le_{b}ms" for b in ACQUIRE_BUCKETS_MS if waited_ms <= b), "inf")
+        metrics.incr(f"db.acquire_wait_bucket.{bucket}")
+
+        slow = waited_ms > self.warn_ms
+        if slow:
+            metrics.incr("db.acquire_slow")
+            print(f"⚠️ DB pool acquire took {waited_ms:.0f} ms "
+                  f"(in use {self._in_use()}/{self.limit}, waiting {self._waiting})")
+
+        if self.adaptive:
+            self._slow_streak = self._slow_streak + 1 if slow else 0
+            if self._slow_streak >= self.adaptive_streak and self.limit < self.adaptive_max:
+                self.limit += 1
+                self._slots.release()  # one more permit = one more connection allowed
+                self._slow_streak = 0
+                metrics.incr("db.pool_grown")
+                print(f"📈 DB pool limit raised to {self.limit}")
+        self._report()
+
+    def _in_use(self) -> int:
+        return self._pool.get_size() - self._pool.get_idle_size()
+
+    def _report(self):
+        if self._pool is None:
+            return
+        metrics.set_gauge("db.pool_size", self._pool.get_size())
+        metrics.set_gauge("db.pool_idle", self._pool.get_idle_size())
+        metrics.set_gauge("db.pool_in_use", self._in_use())
+        metrics.set_gauge("db.pool_waiting", self._waiting)
+        metrics.set_gauge("db.pool_limit", self.limit)
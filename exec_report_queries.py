@@ -0,0 +1,174 @@
+import asyncpg
+
+import exec_report_metrics as metrics
+
+# === QUERY REGISTRY ===
+# Hot statements, run by name so asyncpg's per-connection statement cache prepares each once.
+# Each execution is timed under "sql.<name>"; `/metrics sql.` shows the per-statement table.
+QUERIES = {
+    # Profile + org names in one round trip; no row means the user isn't registered
+    "user_context": """
+        WITH u AS (
+            SELECT user_id, first_name, surname
+            FROM users
+            WHERE user_id = $1
+        ), orgs AS (
+            SELECT array_agg(o.name ORDER BY o.name) AS names
+            FROM user_orgs uo
+            JOIN organizations o ON o.id = uo.org_id
+            WHERE uo.user_id = $1
+        )
+        SELECT u.first_name, u.surname, COALESCE(orgs.names, '{}') AS organizations
+        FROM u CROSS JOIN orgs
+    """,
+    "user_org_roles": """
+        SELECT org_id, admin, executive
+        FROM user_orgs
+        WHERE user_id = $1
+    """,
+    "user_org_ids": """
+        SELECT org_id
+        FROM user_orgs
+        WHERE user_id = $1
+    """,
+    # Update feed, keyset-paginated on (timestamp, id); served by idx_updates_org_feed
+    "feed_latest": """
+        SELECT upd.id, u.username, upd.structured_text, upd.timestamp, upd.image_path, upd.image_file_id
+        FROM updates upd
+        JOIN users u ON upd.user_id = u.user_id
+        WHERE upd.org_id = $1
+        ORDER BY upd.timestamp DESC, upd.id DESC
+        LIMIT $2
+    """,
+    "feed_older": """
+        SELECT upd.id, u.username, upd.structured_text, upd.timestamp, upd.image_path, upd.image_file_id
+        FROM updates upd
+        JOIN users u ON upd.user_id = u.user_id
+        WHERE upd.org_id = $1
+          AND (upd.timestamp, upd.id) < ($2, $3)
+        ORDER BY upd.timestamp DESC, upd.id DESC
+        LIMIT $4
+    """,
+    "feed_newer": """
+        SELECT upd.id, u.username, upd.structured_text, upd.timestamp, upd.image_path, upd.image_file_id
+        FROM updates upd
+        JOIN users u ON upd.user_id = u.user_id
+        WHERE upd.org_id = $1
+          AND (upd.timestamp, upd.id) > ($2, $3)
+        ORDER BY upd.timestamp ASC, upd.id ASC
+        LIMIT $4
+    """,
+    "insert_update": """
+        INSERT INTO updates (user_id, username, org_id, original_text, structured_text, image_path, image_file_id)
+        VALUES ($1, $2, $3, $4, $5, $6, $7)
+        RETURNING id, timestamp
+    """,
+    "set_image_file_id": """
+        UPDATE updates SET image_file_id = $2 WHERE id = $1
+    """,
+    # Fold one update into the org's daily and weekly rollups, keeping the newest $6 bullets per section
+    "rollup_upsert": """
+        INSERT INTO org_rollups AS r
+            (org_id, period, period_start, progress, incidents, reporters, update_count, last_activity)
+        SELECT $1, p.period, date_trunc(p.period, $5::timestamp)::date,
+               $2::text[], $3::text[], ARRAY[$4::bigint], 1, $5::timestamp
+        FROM (VALUES ('day'), ('week')) AS p(period)
+        ON CONFLICT (org_id, period, period_start) DO UPDATE SET
+            progress = (r.progress || EXCLUDED.progress)
+                [greatest(1, cardinality(r.progress) + cardinality(EXCLUDED.progress) - $6 + 1):],
+            incidents = (r.incidents || EXCLUDED.incidents)
+                [greatest(1, cardinality(r.incidents) + cardinality(EXCLUDED.incidents) - $6 + 1):],
+            reporters = CASE WHEN $4::bigint = ANY(r.reporters) THEN r.reporters
+                             ELSE r.reporters || $4::bigint END,
+            update_count = r.update_count + 1,
+            last_activity = greatest(r.last_activity, EXCLUDED.last_activity)
+    """,
+    "rollup_current": """
+        SELECT period_start, progress, incidents, cardinality(reporters) AS reporter_count,
+               update_count, last_activity
+        FROM org_rollups
+        WHERE org_id = $1
+          AND period = $2
+          AND period_start = date_trunc($2, LOCALTIMESTAMP)::date
+    """,
+    # Updates of one org by id (similar-incident lookups)
+    "updates_by_ids": """
+        SELECT upd.id, u.username, upd.structured_text, upd.timestamp
+        FROM updates upd
+        JOIN users u ON upd.user_id = u.user_id
+        WHERE upd.org_id = $1
+          AND upd.id = ANY($2::int[])
+    """,
+    # Full-text search within one org, ranked by ts_rank_cd and keyset-paginated on (rank, id).
+    # The inner query ranks and limits via idx_updates_search; ts_headline only runs on the page.
+    # Matches are wrapped in ⟦ ⟧ so the caller can HTML-escape the snippet before marking them up.
+    "search_first": """
+        SELECT hit.id, hit.rank, hit.timestamp, u.username,
+               ts_headline('english', coalesce(upd.structured_text, upd.original_text, ''), hit.query,
+                           'StartSel=⟦, StopSel=⟧, MaxWords=25, MinWords=8, MaxFragments=2') AS snippet
+        FROM (
+            SELECT upd.id, upd.timestamp, upd.user_id, q.query,
+                   ts_rank_cd(upd.search_tsv, q.query)::real AS rank
+            FROM updates upd, websearch_to_tsquery('english', $2) AS q(query)
+            WHERE upd.org_id = $1
+              AND upd.search_tsv @@ q.query
+            ORDER BY rank DESC, upd.id DESC
+            LIMIT $3
+        ) hit
+        JOIN updates upd ON upd.id = hit.id
+        JOIN users u ON u.user_id = hit.user_id
+        ORDER BY hit.rank DESC, hit.id DESC
+    """,
+    "search_next": """
+        SELECT hit.id, hit.rank, hit.timestamp, u.username,
+               ts_headline('english', coalesce(upd.structured_text, upd.original_text, ''), hit.query,
+                           'StartSel=⟦, StopSel=⟧, MaxWords=25, MinWords=8, MaxFragments=2') AS snippet
+        FROM (
+            SELECT upd.id, upd.timestamp, upd.user_id, q.query,
+                   ts_rank_cd(upd.search_tsv, q.query)::real AS rank
+            FROM updates upd, websearch_to_tsquery('english', $2) AS q(query)
+            WHERE upd.org_id = $1
+              AND upd.search_tsv @@ q.query
+              AND (ts_rank_cd(upd.search_tsv, q.query)::real, upd.id) < ($3::real, $4)
+            ORDER BY rank DESC, upd.id DESC
+            LIMIT $5
+        ) hit
+        JOIN updates upd ON upd.id = hit.id
+        JOIN users u ON u.user_id = hit.user_id
+        ORDER BY hit.rank DESC, hit.id DESC
+    """,
+}
+
+async def prepare_statements(conn):
+    """
+    Pool init hook: check every registered statement parses against the schema.
+    Handles are not kept; asyncpg invalidates them when the connection goes back
+    to the pool, and its per-connection statement cache (DB_STATEMENT_CACHE_SIZE)
+    prepares each query once on first use anyway.
+    """
+    for sql in QUERIES.values():
+        try:
+            await conn.prepare(sql)
+        except asyncpg.PostgresError:
+            # Schema not created yet (first boot); a real mistake surfaces on first use
+            pass
+
+
+async def fetch(conn, name: str, *args):
+    with metrics.timed(f"sql.{name}"):
+        return await conn.fetch(QUERIES[name], *args)
+
+
+async def fetchrow(conn, name: str, *args):
+    with metrics.timed(f"sql.{name}"):
+        return await conn.fetchrow(QUERIES[name], *args)
+
+
+async def execute(conn, name: str, *args):
+    with metrics.timed(f"sql.{name}"):
+        await conn.execute(QUERIES[name], *args)
+
+
+async def fetchval(conn, name: str, *args):
+    with metrics.timed(f"sql.{name}"):
+        return await conn.fetchval(QUERIES[name], *args)
@@ -0,0 +1,184 @@
+import json
+import time
+import asyncio
+
+from telegram.ext import BasePersistence, PersistenceInput, ContextTypes
+
+import exec_report_metrics as metrics
+from settings import SESSION_CACHE_TTL, SESSION_FLUSH_INTERVAL, init_db_pool
+
+
+# === POSTGRES PERSISTENCE ===
+class PostgresPersistence(BasePersistence):
+    """
+    PTB persistence backed by the `sessions` table, so user_data (active org,
+    update state, onboarding answers) and conversation states survive restarts
+    and are shared between bot instances.
+
+    Reads: user_data is not preloaded. Before each update PTB calls
+    refresh_user_data(), which re-reads the row from Postgres at most once per
+    SESSION_CACHE_TTL seconds and otherwise serves the local copy.
+    Writes: PTB hands changed data over every SESSION_FLUSH_INTERVAL seconds;
+    those rows are staged in memory and written in one executemany batch.
+    """
+
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=SESSION_FLUSH_INTERVAL,
+        )
+        self._fetched_at: dict[int, float] = {}
+        # Last JSON we read or wrote per user; a differing dict has unsaved local edits
+        self._snapshots: dict[int, str] = {}
+        # (kind, key) -> JSON text, or None to delete the row
+        self._pending: dict[tuple[str, str], str | None] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    # --- loading ---
+    async def get_user_data(self) -> dict:
+        # Loaded lazily per user in refresh_user_data
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        pool = await init_db_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT key, data FROM sessions WHERE kind = $1", f"conv:{name}"
+            )
+        return {tuple(json.loads(row["key"])): json.loads(row["data"]) for row in rows}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        key = ("user", str(user_id))
+        if key in self._pending or (user_id in self._snapshots and json.dumps(user_data) != self._snapshots[user_id]):
+            # Our unflushed copy is newer than anything in the database
+            return
+
+        fetched_at = self._fetched_at.get(user_id)
+        if fetched_at is not None and time.monotonic() - fetched_at < SESSION_CACHE_TTL:
+            metrics.incr("session.hit")
+            return
+
+        metrics.incr("session.miss")
+        pool = await init_db_pool()
+        async with pool.acquire() as conn:
+            data = await conn.fetchval(
+                "SELECT data FROM sessions WHERE kind = 'user' AND key = $1", str(user_id)
+            )
+        # Mutate in place: handlers already hold a reference to this dict
+        user_data.clear()
+        if data:
+            user_data.update(json.loads(data))
+        self._snapshots[user_id] = json.dumps(user_data)
+        self._fetched_at[user_id] = time.monotonic()
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    # --- staging writes ---
+    async def update_user_data(self, user_id: int, data: dict):
+        snapshot = json.dumps(data)
+        self._stage(("user", str(user_id)), snapshot)
+        self._snapshots[user_id] = snapshot
+        self._fetched_at[user_id] = time.monotonic()
+
+    async def drop_user_data(self, user_id: int):
+        self._stage(("user", str(user_id)), None)
+        self._snapshots.pop(user_id, None)
+        self._fetched_at.pop(user_id, None)
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None):
+        value = None if new_state is None else json.dumps(new_state)
+        self._stage((f"conv:{name}", json.dumps(list(key))), value)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    def _stage(self, key: tuple[str, str], value: str | None):
+        self._pending[key] = value
+        metrics.set_gauge("session.pending", len(self._pending))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    # --- flushing ---
+    async def _flush_pending(self):
+        # Yield once so every update_* call from this persistence cycle lands in the same batch
+        await asyncio.sleep(0)
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        upserts = [(kind, key, value) for (kind, key), value in pending.items() if value is not None]
+        deletes = [(kind, key) for (kind, key), value in pending.items() if value is None]
+
+        try:
+            pool = await init_db_pool()
+            with metrics.timed("session.flush"):
+                async with pool.acquire() as conn:
+                    async with conn.transaction():
+                        if upserts:
+                            await conn.executemany(
+                                """
+                                INSERT INTO sessions (kind, key, data, updated_at)
+                                VALUES ($1, $2, $3::jsonb, NOW())
+                                ON CONFLICT (kind, key) DO UPDATE SET
+                                    data = EXCLUDED.data,
+                                    updated_at = EXCLUDED.updated_at
+                                """,
+                                upserts
+                            )
+                        if deletes:
+                            await conn.executemany(
+                                "DELETE FROM sessions WHERE kind = $1 AND key = $2", deletes
+                            )
+            metrics.incr("session.rows_flushed", len(pending))
+        except Exception as e:
+            print(f"⚠️ Session flush failed, will retry: {e}")
+            # Keep anything that wasn't overwritten in the meantime
+            for key, value in pending.items():
+                self._pending.setdefault(key, value)
+        finally:
+            metrics.set_gauge("session.pending", len(self._pending))
+
+    async def flush(self):
+        """Called by PTB on shutdown: write everything that is still staged."""
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._flush_pending()
+
+
+# === USER STATE ===
+# The per-user "awaiting_update" flag lives in user_data so it is persisted with it.
+def get_user_state(context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    return context.user_data.get("state")
+
+
+def set_user_state(context: ContextTypes.DEFAULT_TYPE, user_id: int, state: str):
+    context.user_data["state"] = state
+    # Handlers may run outside PTB's update cycle (e.g. after background transcription)
+    context.application.mark_data_for_update_persistence(user_ids=user_id)
+
+
+def clear_user_state(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    if context.user_data.pop("state", None) is not None:
+        context.application.mark_data_for_update_persistence(user_ids=user_id)
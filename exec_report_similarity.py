@@ -0,0 +1,264 @@
+import os
+import json
+import math
+import fcntl
+import shutil
+import asyncio
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+
+import exec_report_metrics as metrics
+from exec_report_structured import parse_structured_sections
+from settings import SIMILARITY_DIR, SIMILARITY_DIM, SIMILARITY_TOP_K, SIMILARITY_MIN_SCORE, init_db_pool
+
+INITIAL_CAPACITY = 256
+# Stored rows scored per step, so a query never materializes a weighted copy of the whole index
+QUERY_BLOCK_ROWS = 4096
+
+
+# === FEATURES ===
+def hashed_features(text: str, dim: int) -> np.ndarray:
+    """
+    Log-scaled term frequencies of word unigrams, word bigrams and character
+    4-grams, hashed into `dim` buckets. crc32 keeps buckets stable across
+    processes and restarts (Python's hash() is salted per process).
+    """
+    words = [w for w in "".join(c if c.isalnum() else " " for c in text.casefold()).split() if w]
+    grams = Counter(words)
+    grams.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    for word in words:
+        padded = f"#{word}#"
+        grams.update(padded[i:i + 4] for i in range(len(padded) - 3))
+
+    vector = np.zeros(dim, dtype=np.float32)
+    for gram, count in grams.items():
+        vector[zlib.crc32(gram.encode("utf-8")) % dim] += 1.0 + math.log(count)
+    return vector
+
+
+# === INDEX ===
+class SimilarityIndex:
+    """
+    Per-org TF-IDF index of incident bullets, stored under root/org_<id>/ as
+    memory-mapped arrays: vectors.f32 (raw hashed term frequencies, one row per
+    bullet), rows.i64 (update id, bullet index) and df.i64 (document frequency
+    per bucket), plus header.json with the row count. Rows are appended in
+    place, so restarts reopen the files instead of rebuilding. IDF weights are
+    applied at query time, so they always reflect the current corpus.
+    A per-org flock serializes writers across shard worker processes.
+    """
+
+    def __init__(self, root: str, dim: int):
+        self.root = root
+        self.dim = dim
+
+    def _dir(self, org_id: int) -> str:
+        return os.path.join(self.root, f"org_{org_id}")
+
+    @contextmanager
+    def _locked(self, org_id: int, exclusive: bool):
+        path = self._dir(org_id)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield path
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _header(self, path: str) -> dict | None:
+        try:
+            with open(os.path.join(path, "header.json")) as f:
+                header = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # A different SIMILARITY_DIM makes the stored vectors unusable; treat as missing
+        return header if header.get("dim") == self.dim else None
+
+    def _write_header(self, path: str, header: dict):
+        tmp = os.path.join(path, "header.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(header, f)
+        os.replace(tmp, os.path.join(path, "header.json"))
+
+    def _arrays(self, path: str, capacity: int, mode: str):
+        vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+        rows = np.memmap(os.path.join(path, "rows.i64"), dtype=np.int64, mode=mode, shape=(capacity, 2))
+        df = np.memmap(os.path.join(path, "df.i64"), dtype=np.int64, mode=mode, shape=(self.dim,))
+        return vectors, rows, df
+
+    def _reserve(self, path: str, capacity: int):
+        """Grow (or create) the backing files to hold `capacity` rows; new space reads as zeros."""
+        for name, size in (("vectors.f32", capacity * self.dim * 4),
+                           ("rows.i64", capacity * 2 * 8),
+                           ("df.i64", self.dim * 8)):
+            file_path = os.path.join(path, name)
+            with open(file_path, "ab"):
+                pass
+            if os.path.getsize(file_path) < size:
+                os.truncate(file_path, size)
+
+    def _append(self, path: str, header: dict, items: list[tuple[int, list[str]]]) -> dict:
+        new = [(update_id, index, bullet) for update_id, bullets in items for index, bullet in enumerate(bullets)]
+        if not new:
+            return header
+        count = header["count"]
+        if count + len(new) > header["capacity"]:
+            header["capacity"] = max(INITIAL_CAPACITY, 2 * (count + len(new)))
+            self._reserve(path, header["capacity"])
+
+        vectors, rows, df = self._arrays(path, header["capacity"], "r+")
+        for offset, (update_id, index, bullet) in enumerate(new):
+            vector = hashed_features(bullet, self.dim)
+            vectors[count + offset] = vector
+            rows[count + offset] = (update_id, index)
+            df[vector > 0] += 1
+        vectors.flush()
+        rows.flush()
+        df.flush()
+
+        header["count"] = count + len(new)
+        # Header last: readers only ever see fully written rows
+        self._write_header(path, header)
+        return header
+
+    # --- public API (blocking; call through asyncio.to_thread) ---
+    def exists(self, org_id: int) -> bool:
+        return self._header(self._dir(org_id)) is not None
+
+    def add(self, org_id: int, update_id: int, bullets: list[str]):
+        """Append one update's incident bullets. No-op until the org's index has been built."""
+        with self._locked(org_id, exclusive=True) as path:
+            header = self._header(path)
+            if header is not None:
+                self._append(path, header, [(update_id, bullets)])
+
+    def extend(self, org_id: int, items: list[tuple[int, list[str]]]):
+        """Append updates that are not in the index yet (catch-up after a build)."""
+        with self._locked(org_id, exclusive=True) as path:
+            header = self._header(path)
+            if header is None:
+                return
+            _, rows, _ = self._arrays(path, header["capacity"], "r")
+            indexed = set(rows[:header["count"], 0].tolist())
+            self._append(path, header, [item for item in items if item[0] not in indexed])
+
+    def build(self, org_id: int, items: list[tuple[int, list[str]]]):
+        """(Re)build an org's index from scratch."""
+        with self._locked(org_id, exclusive=True) as path:
+            for name in ("vectors.f32", "rows.i64", "df.i64", "header.json"):
+                try:
+                    os.remove(os.path.join(path, name))
+                except FileNotFoundError:
+                    pass
+            header = {"dim": self.dim, "count": 0, "capacity": INITIAL_CAPACITY}
+            self._reserve(path, INITIAL_CAPACITY)
+            self._append(path, header, items)
+            self._write_header(path, header)
+
+    def drop(self, org_id: int):
+        shutil.rmtree(self._dir(org_id), ignore_errors=True)
+
+    def query(self, org_id: int, update_id: int, bullets: list[str], k: int = SIMILARITY_TOP_K,
+              min_score: float = SIMILARITY_MIN_SCORE) -> list[tuple[int, int, float]]:
+        """
+        Top-k other updates whose incident bullets are closest (cosine over TF-IDF)
+        to `bullets`. Returns (update_id, bullet_index, score), best first, one
+        entry per update.
+        """
+        if not bullets:
+            return []
+        with self._locked(org_id, exclusive=False) as path:
+            header = self._header(path)
+            if header is None or header["count"] == 0:
+                return []
+            n = header["count"]
+            vectors, rows, df = self._arrays(path, header["capacity"], "r")
+            idf = (np.log((1.0 + n) / (1.0 + df)) + 1.0).astype(np.float32)
+            queries = np.stack([hashed_features(b, self.dim) for b in bullets]) * idf
+            queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+            # (v * idf) . q == v . (q * idf), and |v * idf|^2 == v^2 . idf^2: raw rows are never reweighted
+            weighted_queries = (queries * idf).T
+            idf_squared = idf ** 2
+
+            # Best match of any query bullet against every stored bullet
+            scores = np.empty(n, dtype=np.float32)
+            for start in range(0, n, QUERY_BLOCK_ROWS):
+                block = vectors[start:min(n, start + QUERY_BLOCK_ROWS)]
+                norms = np.sqrt(np.square(block) @ idf_squared)
+                norms[norms == 0] = 1.0
+                scores[start:start + len(block)] = (block @ weighted_queries).max(axis=1) / norms
+            ids = np.array(rows[:n, 0])
+            positions = np.array(rows[:n, 1])
+
+        scores[ids == update_id] = -1.0
+
+        # Only the strongest few candidates need sorting
+        top = min(len(scores), k * 8)
+        candidates = np.argpartition(-scores, top - 1)[:top]
+        candidates = candidates[np.argsort(-scores[candidates])]
+
+        results, seen = [], set()
+        for row in candidates:
+            score = float(scores[row])
+            if score < min_score or len(results) == k:
+                break
+            if ids[row] in seen:
+                continue
+            seen.add(ids[row])
+            results.append((int(ids[row]), int(positions[row]), score))
+        return results
+
+
+similarity_index = SimilarityIndex(SIMILARITY_DIR, SIMILARITY_DIM)
+
+
+# === ASYNC HELPERS ===
+async def ensure_index(org_id: int):
+    """Build an org's index from its stored updates the first time it is needed."""
+    if await asyncio.to_thread(similarity_index.exists, org_id):
+        return
+    pool = await init_db_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT id, structured_text FROM updates WHERE org_id = $1 ORDER BY id",
+            org_id
+        )
+    items = [(row["id"], parse_structured_sections(row["structured_text"])["incidents"]) for row in rows]
+    with metrics.timed("similarity.build"):
+        await asyncio.to_thread(similarity_index.build, org_id, items)
+
+    # Updates saved while we were building found no index to add to; pick them up now
+    async with pool.acquire() as conn:
+        late = await conn.fetch(
+            "SELECT id, structured_text FROM updates WHERE org_id = $1 AND id > $2 ORDER BY id",
+            org_id, rows[-1]["id"] if rows else 0
+        )
+    if late:
+        items = [(row["id"], parse_structured_sections(row["structured_text"])["incidents"]) for row in late]
+        await asyncio.to_thread(similarity_index.extend, org_id, items)
+    print(f"🧭 Built similarity index for org {org_id} from {len(rows) + len(late)} updates")
+
+
+async def index_update(org_id: int, update_id: int, incidents: list[str]):
+    """Add a freshly saved update. Failures are logged; the index is only a lookup aid."""
+    if not incidents:
+        return
+    try:
+        await asyncio.to_thread(similarity_index.add, org_id, update_id, incidents)
+    except Exception as e:
+        print(f"⚠️ Failed to index update {update_id} for similarity: {e}")
+
+
+async def find_similar(org_id: int, update_id: int, incidents: list[str]) -> list[tuple[int, int, float]]:
+    await ensure_index(org_id)
+    with metrics.timed("similarity.query"):
+        return await asyncio.to_thread(similarity_index.query, org_id, update_id, incidents)
+
+
+async def drop_indexes(org_ids):
+    for org_id in org_ids:
+        await asyncio.to_thread(similarity_index.drop, org_id)
@@ -0,0 +1,32 @@
+import re
+
+# Plain-text view of Gemini's structured updates, shared by rollups, the similarity index
+# and the feed; no heavy imports so any module can use it.
+
+# === PARSING STRUCTURED OUTPUT ===
+_TAG = re.compile(r"<[^>]+>")
+_BULLET = re.compile(r"^\s*[•\-*]\s*")
+_NONE_BULLETS = {"none", "none.", "n/a", "nil"}
+
+
+def parse_structured_sections(structured_text: str) -> dict[str, list[str]]:
+    """
+    Pull the bullets out of a structured update as plain text:
+    {"progress": [...], "incidents": [...]}. "• None." incident bullets are dropped.
+    """
+    sections = {"progress": [], "incidents": []}
+    current = None
+    for line in (structured_text or "").splitlines():
+        plain = _TAG.sub("", line).strip()
+        lowered = plain.lower()
+        if lowered.startswith("progress"):
+            current = "progress"
+        elif lowered.startswith(("incidence", "incident", "delay")):
+            current = "incidents"
+        elif lowered.startswith("date:"):
+            current = None
+        elif current and _BULLET.match(plain):
+            bullet = _BULLET.sub("", plain).strip()
+            if bullet and not (current == "incidents" and bullet.lower() in _NONE_BULLETS):
+                sections[current].append(bullet)
+    return sections
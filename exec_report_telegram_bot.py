@@ -1,26 +1,43 @@
 import os
+import html
 import asyncio
 import sqlite3
 import logging
 import requests
 import time
 # import whisper
-import assemblyai as aai
-from datetime import datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from telegram import Update, InputFile, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InputFile, InputMediaPhoto, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, ConversationHandler, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
-import google.generativeai as genai
 
-from settings import (GEMINI_API_KEY, GEMINI_API_URL, TELEGRAM_BOT_TOKEN, ASSEMBLYAI_API_KEY, WEBHOOK_URL, PORT,
-                      SUPPORTED_FORMATS, DEV_USER_IDS, ADMIN_USER_IDS, EXEC_IDS,
-                      init_db_pool, pool
+from settings import (GEMINI_API_URL, TELEGRAM_BOT_TOKEN, ASSEMBLYAI_API_KEY, WEBHOOK_URL, PORT,
+                      DEV_USER_IDS, ADMIN_USER_IDS, EXEC_IDS, FEED_PAGE_SIZE,
+                      ROLLUP_MAX_BULLETS, FEED_DELIVERY_MODE, SEARCH_PAGE_SIZE,
+                      WORKER_PROCESSES, UPDATE_CONCURRENCY, UPDATE_MAX_PENDING, init_db_pool, pool
                       )
 
 from exec_report_onboarding import (start, org_choice, org_name, first_name, surname, cancel,
                                     FIRST_NAME, SURNAME, ORG_CHOICE, ORG_NAME, START_KEYBOARD)
                                     
-from exec_report_dev import reset_onboarding, promote_user, demote_user, get_user_roles, clear_user_roles_cache
+from exec_report_dev import (reset_onboarding, promote_user, demote_user, get_user_roles, get_user_org_roles,
+                             clear_user_roles_cache, show_metrics, role_listener)
+from exec_report_llm import structure_text_async
+from exec_report_structured import parse_structured_sections
+from exec_report_transcription import (start_transcription, transcriber, get_cached_transcript,
+                                        file_cache_key)
+from exec_report_telemetry import visits_writer, start_writers, stop_writers
+from exec_report_session import PostgresPersistence, get_user_state, set_user_state, clear_user_state
+import exec_report_queries as queries
+import exec_report_metrics as metrics
+from exec_report_media import media_store, is_media_key
+from exec_report_ingest import ingest
+from exec_report_similarity import index_update, find_similar, drop_indexes
+from exec_report_export import export_org_updates, EXPORT_FORMATS, ExportError
+from exec_report_outbound import OutboundScheduler, bulk_sends
+from exec_report_workers import run_ingress
+from exec_report_concurrency import ChatOrderedUpdateProcessor
 
 
 load_dotenv()
@@ -29,9 +46,6 @@ load_dotenv()
 # === SETUP LOGGING ===
 logging.basicConfig(level=logging.INFO)
 
-# === SETUP GEMINI ===
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-2.5-flash")
 # Load Whisper model once (large-v3)
 # audiomodel = whisper.load_model("turbo")
 
@@ -76,6 +90,12 @@ async def init_db():
         image_path TEXT,
         timestamp TIMESTAMP DEFAULT NOW()
     );
+    -- Telegram file_id of the image, so it can be re-sent without uploading
+    ALTER TABLE updates ADD COLUMN IF NOT EXISTS image_file_id TEXT;
+    -- Full-text search document, kept in sync by Postgres on every insert/update
+    ALTER TABLE updates ADD COLUMN IF NOT EXISTS search_tsv tsvector GENERATED ALWAYS AS (
+        to_tsvector('english', coalesce(original_text, '') || ' ' || coalesce(structured_text, ''))
+    ) STORED;
 
     -- Visits log table
     CREATE TABLE IF NOT EXISTS visits (
@@ -84,12 +104,61 @@ async def init_db():
         visit_time TIMESTAMP DEFAULT NOW()
     );
 
+    -- Daily/weekly per-org summaries, maintained as updates are inserted
+    CREATE TABLE IF NOT EXISTS org_rollups (
+        org_id INTEGER REFERENCES organizations(id) ON DELETE CASCADE,
+        period TEXT NOT NULL,
+        period_start DATE NOT NULL,
+        progress TEXT[] DEFAULT '{}',
+        incidents TEXT[] DEFAULT '{}',
+        reporters BIGINT[] DEFAULT '{}',
+        update_count INTEGER DEFAULT 0,
+        last_activity TIMESTAMP,
+        PRIMARY KEY (org_id, period, period_start)
+    );
+
+    -- Reference counts for content-addressed media blobs (updates.image_path = 'sha256:<hex>')
+    CREATE TABLE IF NOT EXISTS media_blobs (
+        sha256 TEXT PRIMARY KEY,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        size BIGINT,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+
+    -- Content-addressed cache of Gemini-structured updates
+    CREATE TABLE IF NOT EXISTS structured_cache (
+        cache_key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+
+    -- Transcripts of voice notes/audio, keyed by Telegram file_unique_id or audio hash
+    CREATE TABLE IF NOT EXISTS transcript_cache (
+        cache_key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+
+    -- Durable PTB persistence: user_data and conversation states
+    CREATE TABLE IF NOT EXISTS sessions (
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        data JSONB,
+        updated_at TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (kind, key)
+    );
+
     -- Indexes for faster lookups
     CREATE INDEX IF NOT EXISTS idx_user_orgs_user_id ON user_orgs(user_id);
     CREATE INDEX IF NOT EXISTS idx_user_orgs_org_id ON user_orgs(org_id);
     CREATE INDEX IF NOT EXISTS idx_updates_user_id ON updates(user_id);
-    CREATE INDEX IF NOT EXISTS idx_updates_org_id ON updates(org_id);
+    -- Feed index: keyset pages per org walk it without sorting (covers plain org_id lookups too)
+    CREATE INDEX IF NOT EXISTS idx_updates_org_feed ON updates(org_id, timestamp DESC, id DESC);
+    DROP INDEX IF EXISTS idx_updates_org_id;
+    CREATE INDEX IF NOT EXISTS idx_updates_search ON updates USING GIN (search_tsv);
     CREATE INDEX IF NOT EXISTS idx_visits_user_id ON visits(user_id);
+    CREATE INDEX IF NOT EXISTS idx_structured_cache_created_at ON structured_cache(created_at);
+    CREATE INDEX IF NOT EXISTS idx_transcript_cache_created_at ON transcript_cache(created_at);
     """
 
     async with pool.acquire() as conn:
@@ -108,7 +177,7 @@ async def start_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if user_data:
         first_name = user_data.get("first_name", "Friend")
-        orgs = user_data.get("orgs", [])
+        orgs = user_data.get("organizations", [])
         org_display = orgs[0] if orgs else "Earth"
 
         await update.message.reply_text(
@@ -140,32 +209,24 @@ async def org_name_wrapper(update, context):
 
 
 # === USER ROLES ===
-async def is_admin(user_id: int, org_id: int) -> bool:
-    """Check if a user is admin in a specific organization."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT 1 FROM user_orgs WHERE user_id=$1 AND org_id=$2 AND admin=TRUE",
-            user_id, org_id
-        )
-    return row is not None
+# Role checks read from the per-user role cache (exec_report_dev.role_cache) instead of querying each time.
+async def is_admin(user_id: int, org_id: int | None = None) -> bool:
+    """Check if a user is admin in a specific organization (any organization if org_id is None)."""
+    org_roles = await get_user_org_roles(user_id)
+    if org_id is None:
+        return any(r["admin"] for r in org_roles.values())
+    return org_roles.get(org_id, {}).get("admin", False)
 
-async def is_exec(user_id: int, org_id: int) -> bool:
-    """Check if a user is executive in a specific organization."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT 1 FROM user_orgs WHERE user_id=$1 AND org_id=$2 AND executive=TRUE",
-            user_id, org_id
-        )
-    return row is not None
+async def is_exec(user_id: int, org_id: int | None = None) -> bool:
+    """Check if a user is executive in a specific organization (any organization if org_id is None)."""
+    org_roles = await get_user_org_roles(user_id)
+    if org_id is None:
+        return any(r["executive"] for r in org_roles.values())
+    return org_roles.get(org_id, {}).get("executive", False)
 
 async def is_none(user_id: int) -> bool:
     """Check if a user is not part of any organization."""
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT 1 FROM user_orgs WHERE user_id=$1 LIMIT 1",
-            user_id
-        )
-    return row is None
+    return not await get_user_org_roles(user_id)
 
 async def get_all_admin_ids() -> list[int]:
     """Return a list of all user_ids who are admin in any org."""
@@ -175,109 +236,53 @@ async def get_all_admin_ids() -> list[int]:
 
 async def get_admin_org_ids(user_id: int) -> list[int]:
     """Return a list of org IDs where the user is admin."""
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            "SELECT org_id FROM user_orgs WHERE user_id=$1 AND admin=TRUE",
-            user_id
-        )
-        return [r["org_id"] for r in rows]
+    org_roles = await get_user_org_roles(user_id)
+    return [org_id for org_id, r in org_roles.items() if r["admin"]]
 
 
 async def get_user_data(user_id: int) -> dict | None:
     async with pool.acquire() as conn:
+        # Profile + organizations in a single round trip
+        user = await queries.fetchrow(conn, "user_context", user_id)
 
-        # Fetch user core data
-        user = await conn.fetchrow(
-            """
-            SELECT id, first_name, surname
-            FROM users
-            WHERE user_id = $1
-            """,
-            user_id
-        )
-
-        if not user:
-            return None
-
-        user_id = user["id"]
-
-        # Fetch user organizations (may be many)
-        org_rows = await conn.fetch(
-            """
-            SELECT o.name
-            FROM organizations o
-            JOIN user_orgs uo ON o.id = uo.org_id
-            WHERE uo.user_id = $1
-            """,
-            user_id
-        )
+    if not user:
+        return None
 
-        org_list = [r["name"] for r in org_rows]
+    # Log visit (buffered; written in batches off the hot path)
+    visits_writer.record((user_id, datetime.utcnow()))
 
-        # Log visit
-        await conn.execute(
-            "INSERT INTO visits (user_id, visit_time) VALUES ($1, $2)",
-            user_id,
-            datetime.utcnow()
-        )
+    return {
+        "first_name": user["first_name"],
+        "surname": user["surname"],
+        "organizations": list(user["organizations"])
+    }
 
-        return {
-            "first_name": user["first_name"],
-            "surname": user["surname"],
-            "organizations": org_list
-        }
-
-
-# === File Types ===
-def is_supported_file(filename: str) -> bool:
-    """Check if file has a supported audio extension."""
-    _, ext = os.path.splitext(filename)
-    return ext.lower() in SUPPORTED_FORMATS
-
-
-# === STRUCTURE TEXT ===
-def structure_text(text: str) -> str:
-    today = datetime.now().strftime("%d %b %Y")
-
-    prompt = (
-        "You are a helpful assistant that structures work updates for busy executives. "
-        "Limit each section to no more than 4 bullet points and each point to 9 words or less"
-        "Format your response in HTML suitable for Telegram's HTML parse mode. "
-        "Follow this exact template:\n\n"
-        f"<b>Date:</b> {today}\n\n"
-        "<b>Progress:</b>\n"
-        "• [Concise bullet point 1]\n"
-        "• [Concise bullet point 2]\n"
-        "• [Concise bullet point 3]\n"
-        "• [etc., up to 4 points]\n\n"
-        "<b>Incidence/Delay:</b>\n"
-        "• [Concise bullet point 1]\n"
-        "• [etc., or '• None.' if no issues]\n\n"
-        "Ensure the response is clear, concise, and quick to read. Use no extra commentary.\n\n"
-        f"Text: {text}"
-    )
-    response = model.generate_content(prompt)
-    return response.text.strip()
 
 # === STORE IN DB ===
-async def save_update(user_id: int, username: str, org_id: int, original_text: str, structured_text: str, image_path: str | None):
+async def save_update(user_id: int, username: str, org_id: int, original_text: str, structured_text: str, image_path: str | None,
+                      image_file_id: str | None = None) -> int:
+    """Insert an update and fold it into the org's daily/weekly rollups in the same transaction."""
+    sections = parse_structured_sections(structured_text)
     async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO updates 
-                (user_id, username, org_id, original_text, structured_text, image_path)
-            VALUES ($1, $2, $3, $4, $5, $6)
-            """,
-            user_id,
-            username,
-            org_id,
-            original_text,
-            structured_text,
-            image_path
-        )
+        async with conn.transaction():
+            row = await queries.fetchrow(
+                conn, "insert_update",
+                user_id,
+                username,
+                org_id,
+                original_text,
+                structured_text,
+                image_path,
+                image_file_id
+            )
+            await queries.execute(
+                conn, "rollup_upsert",
+                org_id, sections["progress"], sections["incidents"], user_id, row["timestamp"], ROLLUP_MAX_BULLETS
+            )
+    await index_update(org_id, row["id"], sections["incidents"])
+    return row["id"]
 
-# Track user states
-user_state = {}
+# User states ("awaiting_update") live in user_data, persisted by PostgresPersistence
 
 # First screen
 async def handle_start_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -287,9 +292,10 @@ async def handle_start_button(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def more_options(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
-    if is_exec(user_id):
+    org_id = context.user_data.get("active_org_id")
+    if await is_exec(user_id, org_id):
         keyboard = [[KeyboardButton("📝 Send Update")]]
-        if is_admin(user_id):
+        if await is_admin(user_id, org_id):
             keyboard.append([KeyboardButton("🗑️ Clear Updates")])
         keyboard.append([KeyboardButton("📋 Main Menu")])
 
@@ -313,8 +319,6 @@ async def more_options(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_main_menu(update_or_query, context: ContextTypes.DEFAULT_TYPE):
     """Show menu according to role and reset state."""
-    global user_state
-
     if hasattr(update_or_query, "message") and update_or_query.message:
         user_id = update_or_query.message.from_user.id
         chat = update_or_query.message
@@ -325,13 +329,14 @@ async def show_main_menu(update_or_query, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # ✅ Reset state
-    user_state.pop(user_id, None)
+    clear_user_state(context, user_id)
 
     # Build role-based inline menu
-    if is_exec(user_id):
+    if await is_exec(user_id, context.user_data.get("active_org_id")):
         buttons = [
             [InlineKeyboardButton("📄 Last Update", callback_data="last_update")],
             [InlineKeyboardButton("📜 Recent Updates", callback_data="recent_updates")],
+            [InlineKeyboardButton("🗞 Digest", callback_data="digest")],
             [InlineKeyboardButton("🔄 More Options", callback_data="more_options_exec")],
         ]
     else:
@@ -366,9 +371,11 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # if action == "start":
     #     await show_main_menu(update, context)
 
+    org_id = context.user_data.get("active_org_id")
+
     if action == "more_options_exec":
         keyboard = [[InlineKeyboardButton("📝 Send Update", callback_data="send_update")]]
-        if is_admin(user_id):
+        if await is_admin(user_id, org_id):
             keyboard.append([InlineKeyboardButton("🗑️ Clear Updates", callback_data="clear_updates")])
         keyboard.append([InlineKeyboardButton("📂 Switch Organization", callback_data="switch_org")])
         keyboard.append([InlineKeyboardButton("📋 Main Menu", callback_data="main_menu")])
@@ -378,13 +385,25 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await get_updates(update, context, limit=1)
 
     elif action == "recent_updates":
-        await get_updates(update, context, limit=3)
+        await get_updates(update, context, limit=FEED_PAGE_SIZE, paginate=True)
+
+    elif action in ("digest", "digest:day", "digest:week"):
+        await send_digest(update, context, "week" if action == "digest:week" else "day")
+
+    elif action.startswith("similar:"):
+        await show_similar_incidents(update, context, int(action.split(":")[1]))
+
+    elif action.startswith("search:"):
+        await send_search_results(update, context, cursor=decode_search_cursor(action))
+
+    elif action.startswith("feed:"):
+        await get_updates(update, context, limit=FEED_PAGE_SIZE, cursor=decode_feed_cursor(action), paginate=True)
 
     elif action == "send_update":
         await send_update(update, context)
 
     elif action == "clear_updates":
-        if is_admin(user_id):
+        if await is_admin(user_id, org_id):
             await clear_updates(update, context)
         else:
             await query.edit_message_text("🚫 You are not authorized to clear updates.")
@@ -407,10 +426,7 @@ async def switch_org(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
 
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            "SELECT org_id FROM user_orgs WHERE user_id=$1",
-            user_id
-        )
+        rows = await queries.fetch(conn, "user_org_ids", user_id)
 
     if not rows:
         return await update.message.reply_text(
@@ -438,7 +454,7 @@ async def set_active_org_callback(update: Update, context: ContextTypes.DEFAULT_
     org_id = int(data.split(":")[1])
     user_id = query.from_user.id
 
-    # Save *in memory* (your current design)
+    # Saved in user_data, which PostgresPersistence writes to the sessions table
     context.user_data["active_org_id"] = org_id
 
     await query.edit_message_text(
@@ -459,7 +475,7 @@ async def send_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         return
     
-    user_state[user_id] = "awaiting_update"
+    set_user_state(context, user_id, "awaiting_update")
 
     # Inline "Cancel" button (won’t send text into chat)
     keyboard = [
@@ -553,25 +569,27 @@ async def handle_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
     org_tuple = tuple(admin_orgs)
 
     async with pool.acquire() as conn:
+        async with conn.transaction():
+            # Delete the updates, getting back exactly the images they referenced
+            image_rows = await conn.fetch(
+                "DELETE FROM updates WHERE org_id = ANY($1) RETURNING image_path",
+                org_tuple
+            )
+            # ...and the rollups summarizing them
+            await conn.execute(
+                "DELETE FROM org_rollups WHERE org_id = ANY($1)",
+                org_tuple
+            )
+    image_paths = [row["image_path"] for row in image_rows if row["image_path"]]
 
-        # 1. Get image paths first (before deleting)
-        image_rows = await conn.fetch(
-            "SELECT image_path FROM updates WHERE org_id = ANY($1)",
-            org_tuple
-        )
-        image_paths = [row["image_path"] for row in image_rows if row["image_path"]]
+    await drop_indexes(admin_orgs)
 
-        # 2. Delete the updates
-        result = await conn.execute(
-            "DELETE FROM updates WHERE org_id = ANY($1)",
-            org_tuple
-        )
+    # 🧹 Release stored images (blobs go once nothing references them)
+    removed, failed = await media_store.release([p for p in image_paths if is_media_key(p)])
 
-    # 🧹 Delete images from disk
-    removed = 0
-    failed = 0
+    # Legacy images saved straight to disk
     for path in image_paths:
-        if os.path.exists(path):
+        if not is_media_key(path) and os.path.exists(path):
             try:
                 os.remove(path)
                 removed += 1
@@ -588,79 +606,12 @@ async def handle_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 # === HANDLE TEXT, AUDIO + IMAGE ===
-def transcribe_audio_assemblyai(audio_source: str):
-    # base_url = "https://api.assemblyai.com"
-
-    # headers = {
-    #     "authorization": ASSEMBLYAI_API_KEY,
-    # }
-
-    # with open("./my-audio.mp3", "rb") as f:
-    #     response = requests.post(base_url + "/v2/upload",
-    #                         headers=headers,
-    #                         data=f)
-
-    # audio_url = response.json()["upload_url"]
-    # data = {
-    # "audio_url": audio_url,
-    # "speech_model": "universal"
-    # }
-
-    # url = base_url + "/v2/transcript"
-    # response = requests.post(url, json=data, headers=headers)
-
-    # transcript_id = response.json()['id']
-    # polling_endpoint = base_url + "/v2/transcript/" + transcript_id
-
-    # for _ in range(60):
-    #     transcription_result = requests.get(polling_endpoint, headers=headers).json()
-    #     transcript_text = transcription_result['text']
+def duration_seconds(duration) -> int | None:
+    """Telegram media durations are ints, or timedeltas with PTB_TIMEDELTA set."""
+    if isinstance(duration, timedelta):
+        return int(duration.total_seconds())
+    return duration
 
-    #     if transcription_result['status'] == 'completed':
-    #         return transcript_text
-
-    #     elif transcription_result['status'] == 'error':
-    #         raise RuntimeError(f"Transcription failed: {transcription_result['error']}")
-
-    #     else:
-    #         time.sleep(3)
-    """
-    Transcribe local or remote audio using AssemblyAI.
-    Supports mp3, wav, m4a, flac, ogg, webm.
-    """
-    try:
-        # 🧠 Detect if input is URL or local file
-        if audio_source.startswith("http://") or audio_source.startswith("https://"):
-            print(f"Transcribing from URL: {audio_source}")
-        else:
-            if not os.path.exists(audio_source):
-                raise FileNotFoundError(f"File not found: {audio_source}")
-            if not is_supported_file(audio_source):
-                raise ValueError(
-                    f"Unsupported file type: {audio_source}\n"
-                    f"Supported formats: {', '.join(SUPPORTED_FORMATS)}"
-                )
-            print(f"Transcribing local file: {audio_source}")
-
-        # 🪄 Configure and transcribe
-        config = aai.TranscriptionConfig(
-            speech_model=aai.SpeechModel.universal
-        )
-
-        transcriber = aai.Transcriber(config=config)
-        transcript = transcriber.transcribe(audio_source)
-
-        # 🧾 Check for errors
-        if transcript.status == "error":
-            raise RuntimeError(f"Transcription failed: {transcript.error}")
-
-        print("\n Transcription successful:\n")
-        print(transcript.text)
-        return transcript.text
-
-    except Exception as e:
-        print("Error in transcription:", e)
-        return None
 
 async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Ensure we actually got a valid message
@@ -670,56 +621,50 @@ async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
 
     # Get audio/voice file_id safely
-    file_id = None
-    if message.voice:
-        file_id = message.voice.file_id
-    elif message.audio:
-        file_id = message.audio.file_id
-
-    if not file_id:
+    media = message.voice or message.audio
+    if not media:
         await message.reply_text("⚠️ Please send a voice note 🎙 or audio file 🎵.")
         return
 
-    # Build unique temp filename (avoid clashes if multiple audios come in)
-    file_path = f"temp_audio_{message.from_user.id}_{message.message_id}.ogg"
+    async def on_text(transcribed_text: str):
+        if not transcribed_text:
+            await message.reply_text("⚠️ I couldn't understand that audio. Please try again.")
+            return
+        # Reuse your text handler with override
+        await handle_message(update, context, override_text=transcribed_text)
+
+    async def on_error(exc: Exception):
+        await message.reply_text("An error occurred while processing your audio.")
 
-    # Download audio file
+    # Forwards and re-sends of audio we've already transcribed skip the download entirely
+    cached = await get_cached_transcript(file_cache_key(media.file_unique_id))
+    if cached is not None:
+        await on_text(cached["text"])
+        return
+
+    # Download into memory (spills to a temp file only for very large audio)
     try:
-        file = await context.bot.get_file(file_id)
-        await file.download_to_drive(file_path)
+        file = await context.bot.get_file(media.file_id)
+        suffix = os.path.splitext(file.file_path or "")[1] or ".ogg"
+        audio = await ingest(file, size=media.file_size, suffix=suffix)
     except Exception as e:
         print(f"Error downloading audio: {e}")
         await message.reply_text("⚠️ Failed to download audio. Please try again.")
         return
 
-    await message.reply_text("📢 Processing your audio...")
-
-    try:
-        transcript = transcribe_audio_assemblyai(file_path)
-        transcribed_text = transcript.strip()
+    status = await message.reply_text("📢 Processing your audio...")
 
-        # Transcription with Whisper
-        # result = audiomodel.transcribe(file_path)
-        # Get Transcribed Text
-        # transcribed_text = result.get("text", "").strip()
-
-        if not transcribed_text:
-            await message.reply_text("⚠️ I couldn't understand that audio. Please try again.")
-            return
-
-        # Reuse your text handler with override
-        await handle_message(update, context, override_text=transcribed_text)
+    async def on_progress(done: int, total: int):
+        # Long recordings are transcribed in parts; keep the status message current
+        try:
+            await status.edit_text(f"📢 Transcribing your audio... {done}/{total} parts done")
+        except BadRequest:
+            pass
 
-    except Exception as e:
-        print(f"Error in transcription: {e}")
-        await message.reply_text("An error occurred while processing your audio.")
-    finally:
-        # Clean up file
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                print(f"Failed to remove temp file {file_path}: {e}")
+    # Transcription runs in the background so this handler returns immediately
+    start_transcription(audio.source, on_text, on_error=on_error, cleanup=audio.close,
+                        file_unique_id=media.file_unique_id, duration=duration_seconds(media.duration),
+                        on_progress=on_progress)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, override_text=None):
     if not update.message:
@@ -730,7 +675,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, ove
     msg_source = update.message
 
     # Only process if user is in update mode
-    if user_state.get(user_id) != "awaiting_update":
+    if get_user_state(context) != "awaiting_update":
         return
 
     # --- Fetch active organization for this user ---
@@ -740,12 +685,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, ove
         return
 
     image_path = None
+    image_file_id = None
+    photo_bytes = None
 
-    # --- Handle image ---
+    # --- Handle image (stored only once the update is ready to save) ---
     if msg_source.photo:
+        # Telegram's file_id lets executives be sent this photo later without re-uploading it
+        image_file_id = msg_source.photo[-1].file_id
         file = await msg_source.photo[-1].get_file()
-        image_path = f"{user_id}_{datetime.now().timestamp()}.jpg"
-        await file.download_to_drive(image_path)
+        async with await ingest(file, size=msg_source.photo[-1].file_size, suffix=".jpg") as photo:
+            photo_bytes = await photo.read()
 
     # --- Decide text ---
     if override_text:
@@ -755,35 +704,240 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, ove
     else:
         text = msg_source.text or ""
 
-    if not text.strip() and not image_path:
+    if not text.strip() and photo_bytes is None:
         await msg_source.reply_text("⚠️ Please send some text, audio, or an image with a caption.")
         return
 
-    structured = structure_text(text) if text.strip() else "[No text provided]"
+    if text.strip():
+        try:
+            structured = await structure_text_async(text)
+        except asyncio.TimeoutError:
+            await msg_source.reply_text("⏳ Structuring your update took too long. Please send it again.")
+            return
+    else:
+        structured = "[No text provided]"
 
     # --- Save update in Postgres ---
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO updates (user_id, org_id, username, original_text, structured_text, image_path)
-            VALUES ($1, $2, $3, $4, $5, $6)
-            """,
-            user_id, org_id, username, text, structured, image_path
-        )
+    if photo_bytes is not None:
+        image_path = await media_store.put(photo_bytes)
+    try:
+        await save_update(user_id, username, org_id, text, structured, image_path, image_file_id)
+    except BaseException:
+        # No update row points at the image, so give its reference back
+        if image_path:
+            await media_store.release([image_path])
+        raise
 
     # Confirmation message
     await msg_source.reply_text(f"✅ Here's your structured update:\n\n{structured}")
 
     # Reset state
-    user_state.pop(user_id, None)
+    clear_user_state(context, user_id)
 
     # Show role-based main menu again
     await show_main_menu(update, context)
 
 
+# === DIGEST (precomputed rollups) ===
+async def send_digest(update_or_query, context: ContextTypes.DEFAULT_TYPE, period: str = "day"):
+    """Serve the active org's daily or weekly rollup with a single row lookup."""
+    if hasattr(update_or_query, "callback_query") and update_or_query.callback_query:
+        chat = update_or_query.callback_query.message
+        user_id = update_or_query.callback_query.from_user.id
+    elif hasattr(update_or_query, "message") and update_or_query.message:
+        chat = update_or_query.message
+        user_id = update_or_query.message.from_user.id
+    else:
+        return
+
+    org_id = context.user_data.get("active_org_id")
+    if not org_id:
+        await chat.reply_text("⚠ Please select an organization first to view the digest.")
+        return
+
+    if not (await is_exec(user_id, org_id) or await is_admin(user_id, org_id)):
+        await chat.reply_text("🚫 The digest is available to executives and admins only.")
+        return
+
+    async with pool.acquire() as conn:
+        rollup = await queries.fetchrow(conn, "rollup_current", org_id, period)
+
+    other = "week" if period == "day" else "day"
+    buttons = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📅 This week" if other == "week" else "📆 Today", callback_data=f"digest:{other}")],
+        [InlineKeyboardButton("📋 Main Menu", callback_data="main_menu")],
+    ])
+
+    title = "Daily digest" if period == "day" else "Weekly digest"
+    if not rollup:
+        await chat.reply_text(f"🗞 <b>{title}</b>\n\nNo updates yet.", parse_mode="HTML", reply_markup=buttons)
+        return
+
+    progress = "\n".join(f"• {html.escape(b)}" for b in rollup["progress"]) or "• None."
+    incidents = "\n".join(f"• {html.escape(b)}" for b in rollup["incidents"]) or "• None."
+    since = rollup["period_start"].strftime("%d %b %Y")
+    last = rollup["last_activity"].strftime("%d %b %H:%M") if rollup["last_activity"] else "—"
+
+    await chat.reply_text(
+        f"🗞 <b>{title}</b> — since {since}\n"
+        f"👥 {rollup['reporter_count']} reporters · 📝 {rollup['update_count']} updates · 🕒 last {last}\n\n"
+        f"<b>Progress:</b>\n{progress}\n\n"
+        f"<b>Incidence/Delay:</b>\n{incidents}",
+        parse_mode="HTML",
+        reply_markup=buttons
+    )
+
+
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/digest [day|week]"""
+    period = context.args[0].lower() if context.args else "day"
+    if period not in ("day", "week"):
+        await update.message.reply_text("Usage: /digest [day|week]")
+        return
+    await send_digest(update, context, period)
+
+
+# === SEARCH ===
+# Search cursors travel in callback_data as "search:<rank>:<id>"; the terms stay in user_data
+SEARCH_MARK_START, SEARCH_MARK_END = "⟦", "⟧"
+
+
+def format_search_snippet(snippet: str) -> str:
+    """Escape the ts_headline snippet, then turn its match markers into bold."""
+    return (html.escape(snippet)
+            .replace(SEARCH_MARK_START, "<b>")
+            .replace(SEARCH_MARK_END, "</b>"))
+
+
+async def send_search_results(update_or_query, context: ContextTypes.DEFAULT_TYPE, cursor=None):
+    """One ranked page of matches for the stored search terms in the active org."""
+    if hasattr(update_or_query, "callback_query") and update_or_query.callback_query:
+        chat = update_or_query.callback_query.message
+    elif hasattr(update_or_query, "message") and update_or_query.message:
+        chat = update_or_query.message
+    else:
+        return
+
+    org_id = context.user_data.get("active_org_id")
+    terms = context.user_data.get("search_terms")
+    if not org_id:
+        await chat.reply_text("⚠ Please select an organization first to search updates.")
+        return
+    if not terms:
+        await chat.reply_text("Usage: /search <terms>")
+        return
+
+    async with pool.acquire() as conn:
+        if cursor is None:
+            rows = await queries.fetch(conn, "search_first", org_id, terms, SEARCH_PAGE_SIZE)
+        else:
+            rows = await queries.fetch(conn, "search_next", org_id, terms, cursor[0], cursor[1], SEARCH_PAGE_SIZE)
+
+    menu = [InlineKeyboardButton("📋 Main Menu", callback_data="main_menu")]
+    if not rows:
+        text = (f"🔎 No updates match <b>{html.escape(terms)}</b>." if cursor is None
+                else "🔎 No more results.")
+        await chat.reply_text(text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup([menu]))
+        return
+
+    lines = [f"🔎 Results for <b>{html.escape(terms)}</b>:"]
+    for row in rows:
+        lines.append(
+            f"👤 <b>@{html.escape(row['username'] or '')}</b> · {row['timestamp'].strftime('%d %b %Y %H:%M')}\n"
+            f"{format_search_snippet(row['snippet'])}"
+        )
+
+    buttons = []
+    if len(rows) == SEARCH_PAGE_SIZE:
+        last = rows[-1]
+        buttons.append([InlineKeyboardButton("🔎 More results", callback_data=f"search:{last['rank']!r}:{last['id']}")])
+    buttons.append(menu)
+    await chat.reply_text("\n\n".join(lines), parse_mode="HTML", reply_markup=InlineKeyboardMarkup(buttons))
+
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/search <terms> — ranked full-text search over the active org's updates."""
+    terms = " ".join(context.args).strip()
+    if not terms:
+        await update.message.reply_text("Usage: /search <terms>")
+        return
+    context.user_data["search_terms"] = terms
+    await send_search_results(update, context)
+
+
+def decode_search_cursor(data: str) -> tuple[float, int]:
+    _, rank, update_id = data.split(":")
+    return float(rank), int(update_id)
+
+
+# === EXPORT ===
+# Bots can upload documents of up to 50 MB
+DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [csv|parquet] — every update in the active org as a file (admins only)."""
+    message = update.message
+    user_id = message.from_user.id
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in EXPORT_FORMATS:
+        await message.reply_text("Usage: /export [csv|parquet]")
+        return
+
+    org_id = context.user_data.get("active_org_id")
+    if not org_id:
+        await message.reply_text("⚠ Please select an organization first to export its updates.")
+        return
+    if not await is_admin(user_id, org_id):
+        await message.reply_text("🚫 Only admins can export updates.")
+        return
+
+    status = await message.reply_text("📦 Preparing your export...")
+    try:
+        path = await export_org_updates(org_id, fmt)
+    except ExportError as e:
+        await status.edit_text(f"⚠️ {e}")
+        return
+    except Exception as e:
+        print(f"Error exporting updates for org {org_id}: {e}")
+        await status.edit_text("⚠️ The export failed. Please try again later.")
+        return
+
+    try:
+        if os.path.getsize(path) > DOCUMENT_LIMIT:
+            await status.edit_text("⚠️ The export is larger than Telegram's 50 MB limit for bot uploads.")
+            return
+        filename = f"org_{org_id}_updates_{datetime.now():%Y%m%d}{'.csv.gz' if fmt == 'csv' else '.parquet'}"
+        with open(path, "rb") as f:
+            await message.reply_document(document=f, filename=filename)
+        await status.delete()
+    finally:
+        os.remove(path)
+
+
 # === Get Updates ===
+# Feed cursors travel in callback_data as "feed:<o|n>:<timestamp µs>:<id>"
+FEED_OLDER, FEED_NEWER = "o", "n"
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_feed_cursor(direction: str, row) -> str:
+    micros = (row["timestamp"] - EPOCH) // timedelta(microseconds=1)
+    return f"feed:{direction}:{micros}:{row['id']}"
+
+
+def decode_feed_cursor(data: str) -> tuple[str, datetime, int]:
+    _, direction, micros, update_id = data.split(":")
+    return direction, EPOCH + timedelta(microseconds=int(micros)), int(update_id)
+
+
 # === /get_updates COMMAND (with images) ===
-async def get_updates(update_or_query, context: ContextTypes.DEFAULT_TYPE, limit=3):
+async def get_updates(update_or_query, context: ContextTypes.DEFAULT_TYPE, limit=3, cursor=None, paginate=False):
+    """
+    Send a page of the active org's updates, oldest-first.
+    With `cursor` (direction, timestamp, id) the page starts just past that update;
+    with `paginate` the page ends with Older/Newer buttons instead of the main menu.
+    """
     # Determine chat object
     if hasattr(update_or_query, "message") and update_or_query.message:
         chat = update_or_query.message
@@ -802,64 +956,342 @@ async def get_updates(update_or_query, context: ContextTypes.DEFAULT_TYPE, limit
         await chat.reply_text("⚠ Please select an organization first to view updates.")
         return
 
-    # --- Fetch latest updates for this org ---
+    # --- Fetch one page of updates for this org (newest first) ---
+    # One extra row tells us whether there is more beyond the page in the direction we're going
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT u.username, upd.structured_text, upd.timestamp, upd.image_path
-            FROM updates upd
-            JOIN users u ON upd.user_id = u.user_id
-            WHERE upd.org_id = $1
-            ORDER BY upd.timestamp DESC
-            LIMIT $2
-            """,
-            org_id, limit
-        )
+        if cursor is None:
+            rows = await queries.fetch(conn, "feed_latest", org_id, limit + 1)
+        elif cursor[0] == FEED_OLDER:
+            rows = await queries.fetch(conn, "feed_older", org_id, cursor[1], cursor[2], limit + 1)
+        else:
+            rows = await queries.fetch(conn, "feed_newer", org_id, cursor[1], cursor[2], limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if cursor is not None and cursor[0] == FEED_NEWER:
+        rows.reverse()
 
     if not rows:
-        await chat.reply_text("No updates recorded yet for this organization.")
+        if cursor is None:
+            await chat.reply_text("No updates recorded yet for this organization.")
+        else:
+            await chat.reply_text(
+                "No more updates in that direction.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📋 Main Menu", callback_data="main_menu")]])
+            )
         return
 
-    # Send updates oldest-first
-    for row in reversed(rows):
+    # Send updates oldest-first; feed sends yield to other users' interactive replies
+    with bulk_sends():
+        if FEED_DELIVERY_MODE == "bulk":
+            await deliver_updates_bulk(chat, list(reversed(rows)))
+        else:
+            await deliver_updates_single(chat, list(reversed(rows)))
+
+    if not paginate:
+        # Return to main menu
+        await show_main_menu(update_or_query, context)
+        return
+
+    # Coming from the other direction, the cursor's own update proves that side isn't empty
+    going_newer = cursor is not None and cursor[0] == FEED_NEWER
+    nav = []
+    if going_newer or has_more:
+        nav.append(InlineKeyboardButton("⬅️ Older", callback_data=encode_feed_cursor(FEED_OLDER, rows[-1])))
+    if cursor is not None and (not going_newer or has_more):
+        nav.append(InlineKeyboardButton("Newer ➡️", callback_data=encode_feed_cursor(FEED_NEWER, rows[0])))
+    buttons = [nav] if nav else []
+    buttons.append([InlineKeyboardButton("📋 Main Menu", callback_data="main_menu")])
+    await chat.reply_text("📜 More updates:", reply_markup=InlineKeyboardMarkup(buttons))
+
+
+# === FEED DELIVERY ===
+# Telegram limits: 2-10 items per media group, 1024-char captions, 4096-char messages
+ALBUM_MAX_ITEMS = 10
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+TEXT_SEPARATOR = "\n\n———\n\n"
+
+
+def format_update_text(username, structured_text) -> str:
+    return (
+        f"👤 <b>@{username}</b>\n"
+        f"{structured_text}"
+    )
+
+
+def album_caption(row) -> str:
+    """The update's text, or just the author when it won't fit (the text then goes in the text stream)."""
+    caption = format_update_text(row["username"], row["structured_text"])
+    if len(caption) > CAPTION_LIMIT:
+        caption = f"👤 <b>@{row['username']}</b>"
+    return caption
+
+
+def has_image(row) -> bool:
+    return bool(row["image_file_id"]) or is_media_key(row["image_path"]) or bool(
+        row["image_path"] and os.path.exists(row["image_path"])
+    )
+
+
+async def deliver_updates_single(chat, rows):
+    """One message per update, oldest-first."""
+    for row in rows:
         await send_executive_update(
             chat,
             username=row["username"],
             timestamp=row["timestamp"],
             structured_text=row["structured_text"],
             image_path=row["image_path"],
+            image_file_id=row["image_file_id"],
+            update_id=row["id"],
         )
-        await asyncio.sleep(0.2)  # avoid spamming too quickly
 
-    # Return to main menu
-    await show_main_menu(update_or_query, context)
 
+async def deliver_updates_bulk(chat, rows):
+    """
+    Image updates go out as albums of up to 10, text-only updates are packed into
+    as few messages as fit in 4096 chars. The two streams are sent concurrently;
+    each stream keeps oldest-first order. Albums and packed text can't carry
+    per-update buttons, so "Similar past incidents" buttons follow in one message.
+    """
+    image_rows, texts = [], []
+    for row in rows:
+        text = format_update_text(row["username"], row["structured_text"])
+        if has_image(row):
+            image_rows.append(row)
+            if len(text) > CAPTION_LIMIT:
+                # Too long for a caption: album shows the photo, full text joins the text stream
+                texts.append(text)
+        else:
+            texts.append(text)
 
-async def send_executive_update(chat, username, timestamp, structured_text, image_path=None):
-    """Send a nicely formatted executive-style update with optional image."""
-    message_text = (
-        f"👤 <b>@{username}</b>\n"
-        f"{structured_text}"
-    )
+    sent_alone, _ = await asyncio.gather(send_albums(chat, image_rows), send_text_batches(chat, texts))
+    await send_similar_buttons(chat, [row for row in rows if row["id"] not in sent_alone])
+
+
+async def send_similar_buttons(chat, rows):
+    """One "Similar past incidents" button per incident-bearing update in `rows`."""
+    buttons = [
+        [InlineKeyboardButton(
+            f"🔁 @{row['username']} · {row['timestamp'].strftime('%d %b %H:%M')}",
+            callback_data=f"similar:{row['id']}"
+        )]
+        for row in rows
+        if parse_structured_sections(row["structured_text"])["incidents"]
+    ]
+    if buttons:
+        await chat.reply_text("🔁 Similar past incidents:", reply_markup=InlineKeyboardMarkup(buttons))
+
+
+async def send_text_batches(chat, texts: list[str]):
+    batch = ""
+    for text in texts:
+        if batch and len(batch) + len(TEXT_SEPARATOR) + len(text) > MESSAGE_LIMIT:
+            await chat.reply_text(batch, parse_mode="HTML")
+            batch = ""
+        batch = f"{batch}{TEXT_SEPARATOR}{text}" if batch else text
+    if batch:
+        await chat.reply_text(batch, parse_mode="HTML")
+
+
+async def send_albums(chat, rows) -> set[int]:
+    """Returns the ids of updates sent as their own message (those already have their buttons)."""
+    sent_alone = set()
+    for offset in range(0, len(rows), ALBUM_MAX_ITEMS):
+        group = rows[offset:offset + ALBUM_MAX_ITEMS]
+        if len(group) == 1:
+            # Media groups need at least two items
+            row = group[0]
+            await send_executive_update(
+                chat, row["username"], row["timestamp"], row["structured_text"],
+                image_path=row["image_path"], image_file_id=row["image_file_id"], update_id=row["id"],
+                caption=album_caption(row)
+            )
+            sent_alone.add(row["id"])
+        elif not await send_album(chat, group):
+            sent_alone.update(row["id"] for row in group)
+    return sent_alone
+
+
+async def load_photo(row):
+    """What to hand Telegram for this row's image: its file_id, or the stored bytes."""
+    if row["image_file_id"]:
+        return row["image_file_id"]
+    if is_media_key(row["image_path"]):
+        return await media_store.get(row["image_path"])
+    return await asyncio.to_thread(_read_bytes, row["image_path"])
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def send_album(chat, rows) -> bool:
+    """Send rows as one album. Returns False if it fell back to one message per update."""
+    photos = await asyncio.gather(*(load_photo(row) for row in rows))
+    media = []
+    for row, photo in zip(rows, photos):
+        media.append(InputMediaPhoto(media=photo, caption=album_caption(row), parse_mode="HTML"))
 
-    if image_path and os.path.exists(image_path):
+    try:
+        messages = await chat.reply_media_group(media=media)
+    except BadRequest as e:
+        # Usually one stale file_id; send individually so each can fall back to an upload
+        print(f"⚠️ Album send failed, sending updates one by one: {e}")
+        metrics.incr("media.album_fallbacks")
+        for row in rows:
+            await send_executive_update(
+                chat, row["username"], row["timestamp"], row["structured_text"],
+                image_path=row["image_path"], image_file_id=row["image_file_id"], update_id=row["id"],
+                caption=album_caption(row)
+            )
+        return False
+
+    metrics.incr("media.albums_sent")
+    # Remember file_ids for anything we had to upload
+    for row, message in zip(rows, messages):
+        if not row["image_file_id"] and message.photo:
+            await save_image_file_id(row["id"], message.photo[-1].file_id)
+    return True
+
+
+async def send_executive_update(chat, username, timestamp, structured_text, image_path=None,
+                                image_file_id=None, update_id=None, caption=None):
+    """
+    Send a nicely formatted executive-style update with optional image.
+    Images go by Telegram file_id when we have one; otherwise they are uploaded
+    once and the returned file_id is saved on the update row for next time.
+    `caption` replaces the update text on the photo (bulk delivery sends long
+    text separately).
+    """
+    message_text = format_update_text(username, structured_text)
+    if caption is None:
+        caption = message_text
+    markup = similar_markup(update_id, structured_text)
+
+    if image_file_id:
+        try:
+            await chat.reply_photo(photo=image_file_id, caption=caption, parse_mode="HTML", reply_markup=markup)
+            metrics.incr("media.file_id_sends")
+            return
+        except BadRequest as e:
+            # Stale or foreign file_id: fall back to uploading the stored bytes
+            print(f"⚠️ Telegram rejected file_id for update {update_id}: {e}")
+            metrics.incr("media.file_id_rejected")
+
+    if is_media_key(image_path):
+        sent = await chat.reply_photo(
+            photo=await media_store.get(image_path),
+            caption=caption,
+            parse_mode="HTML",
+            reply_markup=markup
+        )
+    elif image_path and os.path.exists(image_path):
         with open(image_path, "rb") as img_file:
-            await chat.reply_photo(
+            sent = await chat.reply_photo(
                 photo=InputFile(img_file),
-                caption=message_text,
-                parse_mode="HTML"
+                caption=caption,
+                parse_mode="HTML",
+                reply_markup=markup
             )
     else:
-        await chat.reply_text(message_text, parse_mode="HTML")
+        await chat.reply_text(message_text, parse_mode="HTML", reply_markup=markup)
+        return
 
+    metrics.incr("media.uploads")
+    if update_id and sent.photo:
+        await save_image_file_id(update_id, sent.photo[-1].file_id)
 
-# === MAIN FUNCTION ===
-async def main():
-    init_db()
 
-    await init_db_pool()
+def similar_markup(update_id, structured_text) -> InlineKeyboardMarkup | None:
+    """The "Similar past incidents" button, shown only on updates that report an incident."""
+    if not update_id or not parse_structured_sections(structured_text)["incidents"]:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🔁 Similar past incidents", callback_data=f"similar:{update_id}")]])
+
+
+async def show_similar_incidents(update: Update, context: ContextTypes.DEFAULT_TYPE, update_id: int):
+    """Past updates in the active org whose incident bullets best match this update's."""
+    chat = update.callback_query.message
+    org_id = context.user_data.get("active_org_id")
+    if not org_id:
+        await chat.reply_text("⚠ Please select an organization first.")
+        return
+
+    async with pool.acquire() as conn:
+        source = await queries.fetch(conn, "updates_by_ids", org_id, [update_id])
+    if not source:
+        await chat.reply_text("⚠ That update is no longer available in this organization.")
+        return
 
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    incidents = parse_structured_sections(source[0]["structured_text"])["incidents"]
+    matches = await find_similar(org_id, update_id, incidents)
+
+    menu = InlineKeyboardMarkup([[InlineKeyboardButton("📋 Main Menu", callback_data="main_menu")]])
+    if matches:
+        async with pool.acquire() as conn:
+            rows = await queries.fetch(conn, "updates_by_ids", org_id, [m[0] for m in matches])
+        by_id = {row["id"]: row for row in rows}
+    else:
+        by_id = {}
+
+    lines = []
+    for match_id, bullet_index, score in matches:
+        row = by_id.get(match_id)
+        if row is None:
+            continue  # deleted since it was indexed
+        bullets = parse_structured_sections(row["structured_text"])["incidents"]
+        bullet = bullets[bullet_index] if bullet_index < len(bullets) else "; ".join(bullets)
+        lines.append(
+            f"👤 <b>@{html.escape(row['username'] or '')}</b> · {row['timestamp'].strftime('%d %b %Y')} "
+            f"· {score:.0%} match\n• {html.escape(bullet)}"
+        )
+
+    if not lines:
+        await chat.reply_text("🔁 No similar incidents have been reported before.", reply_markup=menu)
+        return
+    await chat.reply_text("🔁 <b>Similar past incidents:</b>\n\n" + "\n\n".join(lines),
+                          parse_mode="HTML", reply_markup=menu)
+
+
+async def save_image_file_id(update_id: int, file_id: str):
+    async with pool.acquire() as conn:
+        await queries.execute(conn, "set_image_file_id", update_id, file_id)
+
+
+# === APPLICATION ===
+async def post_init(app):
+    await init_db_pool()
+    await start_writers()
+    if WORKER_PROCESSES > 0:
+        # Role changes made in one shard must reach the cache in every other shard
+        role_listener.start()
+
+
+async def post_shutdown(app):
+    await role_listener.stop()
+    await stop_writers()
+    await transcriber.aclose()
+
+
+def build_application():
+    """Build the bot with all handlers registered. Used by the webhook process and by shard workers."""
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .persistence(PostgresPersistence())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Every Bot API call is paced by per-chat and global token buckets
+        .rate_limiter(OutboundScheduler())
+    )
+    if UPDATE_CONCURRENCY > 0:
+        # Different chats in parallel, same chat strictly in order (onboarding + user state rely on it)
+        builder = builder.concurrent_updates(
+            ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, max(UPDATE_MAX_PENDING, UPDATE_CONCURRENCY))
+        )
+    app = builder.build()
 
     # Conversation for org selection
     conv_handler = ConversationHandler(
@@ -874,6 +1306,8 @@ async def main():
             ORG_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, org_name_wrapper)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="onboarding",
+        persistent=True,
     )
     app.add_handler(conv_handler)
     
@@ -895,11 +1329,30 @@ async def main():
     app.add_handler(CommandHandler("resetonboarding", reset_onboarding))
     app.add_handler(CommandHandler("promote_user", promote_user))
     app.add_handler(CommandHandler("demote_user", demote_user))
+    app.add_handler(CommandHandler("metrics", show_metrics))
+
+    app.add_handler(CommandHandler("digest", digest_command))
+    app.add_handler(CommandHandler("search", search_command))
+    app.add_handler(CommandHandler("export", export_command))
 
     # === MESSAGE INPUTS (actual updates from users) ===
     app.add_handler(MessageHandler(filters.TEXT | filters.PHOTO, handle_message))
     app.add_handler(MessageHandler(filters.VOICE | filters.AUDIO, handle_audio))
 
+    return app
+
+
+# === MAIN FUNCTION ===
+async def main():
+    await init_db()
+
+    # Ingress mode: this process only receives webhooks; N shard workers run the handlers
+    if WORKER_PROCESSES > 0:
+        await run_ingress(build_application, WORKER_PROCESSES)
+        return
+
+    app = build_application()
+
     # Run the bot
     # app.run_polling()
 
@@ -914,8 +1367,10 @@ async def main():
     # 👇 FIXED PART
     # run_webhook() tries to close loop internally — Render keeps it alive.
     # So we just run the internal webhook startup manually:
+    # (post_init/post_shutdown only run automatically inside run_polling/run_webhook)
     await app.initialize()
     await app.start()
+    await post_init(app)
     await app.updater.start_webhook(
         listen="0.0.0.0",
         port=port,
@@ -925,8 +1380,14 @@ async def main():
 
     print("✅ Webhook server running. Waiting for Telegram updates...")
 
-    # Keep it running forever
-    await asyncio.Event().wait()
+    # Keep it running forever; on shutdown flush telemetry and close clients
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await app.updater.stop()
+        await app.stop()
+        await post_shutdown(app)
+        await app.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,110 @@
+import asyncio
+
+import asyncpg
+
+import exec_report_metrics as metrics
+from settings import (TELEMETRY_BUFFER_SIZE, TELEMETRY_FLUSH_SIZE, TELEMETRY_FLUSH_INTERVAL,
+                      init_db_pool)
+
+
+# === WRITE-BEHIND EVENT WRITER ===
+class EventWriter:
+    """
+    Buffers append-only rows in memory and writes them with COPY
+    (copy_records_to_table) once `flush_size` rows are waiting or every
+    `flush_interval` seconds. record() never waits on the database; when the
+    buffer holds `max_buffer` rows new events are dropped and counted. A batch
+    the database rejects is split until only the bad rows are dropped.
+    """
+
+    def __init__(self, table: str, columns: tuple[str, ...], max_buffer: int = TELEMETRY_BUFFER_SIZE,
+                 flush_size: int = TELEMETRY_FLUSH_SIZE, flush_interval: float = TELEMETRY_FLUSH_INTERVAL):
+        self.table = table
+        self.columns = columns
+        self.max_buffer = max_buffer
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer: list[tuple] = []
+        self._loop_task: asyncio.Task | None = None
+        self._flush_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def record(self, row: tuple) -> bool:
+        """Queue one row. Returns False if it was dropped because the buffer is full."""
+        if len(self._buffer) >= self.max_buffer:
+            metrics.incr(f"telemetry.{self.table}.dropped")
+            return False
+
+        self._buffer.append(row)
+        metrics.set_gauge(f"telemetry.{self.table}.buffered", len(self._buffer))
+        if len(self._buffer) >= self.flush_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+        return True
+
+    async def flush(self):
+        async with self._lock:
+            rows, self._buffer = self._buffer, []
+            if not rows:
+                return
+            try:
+                pool = await init_db_pool()
+                with metrics.timed(f"telemetry.{self.table}.flush"):
+                    async with pool.acquire() as conn:
+                        written = await self._copy(conn, rows)
+                metrics.incr(f"telemetry.{self.table}.written", written)
+            except Exception as e:
+                # Connection trouble: put rows back, up to the buffer limit
+                print(f"⚠️ {self.table} flush failed, will retry: {e}")
+                keep = rows[:max(0, self.max_buffer - len(self._buffer))]
+                self._buffer = keep + self._buffer
+                metrics.incr(f"telemetry.{self.table}.dropped", len(rows) - len(keep))
+            finally:
+                metrics.set_gauge(f"telemetry.{self.table}.buffered", len(self._buffer))
+
+    async def _copy(self, conn, rows: list[tuple]) -> int:
+        """
+        COPY `rows`; if the database rejects them (e.g. a user deleted meanwhile),
+        retry each half so only the offending rows are dropped. Returns rows written.
+        """
+        try:
+            await conn.copy_records_to_table(self.table, records=rows, columns=self.columns)
+            return len(rows)
+        except asyncpg.PostgresError as e:
+            if len(rows) == 1:
+                print(f"⚠️ Dropping {self.table} row {rows[0]}: {e}")
+                metrics.incr(f"telemetry.{self.table}.dropped")
+                return 0
+        middle = len(rows) // 2
+        return await self._copy(conn, rows[:middle]) + await self._copy(conn, rows[middle:])
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the timer and write whatever is still buffered."""
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
+        await self.flush()
+
+
+visits_writer = EventWriter("visits", ("user_id", "visit_time"))
+
+# Every writer here is started in post_init and flushed in post_shutdown
+writers = [visits_writer]
+
+
+async def start_writers():
+    for writer in writers:
+        writer.start()
+
+
+async def stop_writers():
+    for writer in writers:
+        await writer.stop()
@@ -0,0 +1,451 @@
+import io
+import os
+import re
+import json
+import asyncio
+import hashlib
+import importlib.util
+import multiprocessing as mp
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import httpx
+
+import exec_report_metrics as metrics
+from exec_report_cache import TwoTierCache, content_key
+from settings import (ASSEMBLYAI_API_KEY, ASSEMBLYAI_BASE_URL, ASSEMBLYAI_MAX_CONCURRENCY,
+                      ASSEMBLYAI_POLL_INTERVAL, ASSEMBLYAI_POLL_MAX_INTERVAL, ASSEMBLYAI_TIMEOUT,
+                      SUPPORTED_FORMATS, AUDIO_PREPROCESS, TRANSCRIPTION_BACKEND, WHISPER_MODEL_SIZE,
+                      WHISPER_COMPUTE_TYPE, WHISPER_WORKERS, WHISPER_THREADS, WHISPER_QUEUE_SIZE,
+                      TRANSCRIPT_CACHE_SIZE, TRANSCRIPT_CACHE_TTL, LONG_AUDIO_MIN_SECONDS,
+                      LONG_AUDIO_CHUNK_SECONDS, LONG_AUDIO_OVERLAP_SECONDS, LONG_AUDIO_CONCURRENCY)
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Longest run of words compared when removing the overlap between neighbouring chunks
+MAX_OVERLAP_WORDS = 40
+
+
+class TranscriptionError(RuntimeError):
+    """Raised when a transcription job fails or times out."""
+
+
+def is_supported_file(filename: str) -> bool:
+    """Check if file has a supported audio extension."""
+    _, ext = os.path.splitext(filename)
+    return ext.lower() in SUPPORTED_FORMATS
+
+
+# === BACKENDS ===
+class TranscriptionBackend:
+    """
+    Turns audio (raw bytes, a local file path or, where supported, a URL) into
+    {"text": ..., "language": ...}. `name` and `model` identify which engine
+    produced a transcript; `max_concurrency` is how many jobs it runs at once.
+    """
+
+    name = "base"
+    model = ""
+    max_concurrency = 1
+
+    async def transcribe(self, audio: bytes | bytearray | str) -> dict:
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class AssemblyAIClient(TranscriptionBackend):
+    """
+    Non-blocking AssemblyAI client: upload, submit, then poll with backoff.
+    base_url is configurable so it can run against a local stand-in server.
+    """
+
+    name = "assemblyai"
+    model = "universal"
+
+    def __init__(self, api_key: str | None = ASSEMBLYAI_API_KEY, base_url: str = ASSEMBLYAI_BASE_URL,
+                 max_concurrency: int = ASSEMBLYAI_MAX_CONCURRENCY,
+                 poll_interval: float = ASSEMBLYAI_POLL_INTERVAL,
+                 poll_max_interval: float = ASSEMBLYAI_POLL_MAX_INTERVAL,
+                 timeout: float = ASSEMBLYAI_TIMEOUT):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.poll_interval = poll_interval
+        self.poll_max_interval = poll_max_interval
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._client: httpx.AsyncClient | None = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"authorization": self.api_key or ""},
+                timeout=httpx.Timeout(60.0),
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def upload(self, audio: bytes | bytearray | str) -> str:
+        """Upload raw bytes or a local file and return AssemblyAI's upload_url."""
+        if isinstance(audio, str):
+            if not os.path.exists(audio):
+                raise TranscriptionError(f"File not found: {audio}")
+            if not is_supported_file(audio):
+                raise TranscriptionError(
+                    f"Unsupported file type: {audio}\n"
+                    f"Supported formats: {', '.join(SUPPORTED_FORMATS)}"
+                )
+            content = _read_file_chunks(audio)
+        else:
+            content = bytes(audio)
+
+        response = await self._http().post("/v2/upload", content=content)
+        response.raise_for_status()
+        return response.json()["upload_url"]
+
+    async def submit(self, audio_url: str) -> str:
+        """Create a transcript job and return its id."""
+        response = await self._http().post(
+            "/v2/transcript",
+            json={"audio_url": audio_url, "speech_model": self.model},
+        )
+        response.raise_for_status()
+        return response.json()["id"]
+
+    async def wait(self, transcript_id: str) -> dict:
+        """Poll a transcript until it completes, backing off between polls. Returns the transcript JSON."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        delay = self.poll_interval
+
+        while True:
+            try:
+                response = await self._http().get(f"/v2/transcript/{transcript_id}")
+                response.raise_for_status()
+                result = response.json()
+            except httpx.TransportError as e:
+                print(f"⚠️ AssemblyAI poll failed for {transcript_id}: {e}")
+                result = {"status": "retry"}
+
+            if result["status"] == "completed":
+                return result
+            if result["status"] == "error":
+                raise TranscriptionError(f"Transcription failed: {result.get('error')}")
+
+            if loop.time() + delay > deadline:
+                raise TranscriptionError(f"Transcription {transcript_id} timed out after {self.timeout:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, self.poll_max_interval)
+
+    async def transcribe(self, audio: bytes | bytearray | str) -> dict:
+        """Transcribe bytes, a local file or a public URL. At most max_concurrency jobs run at once."""
+        async with self._slots:
+            if isinstance(audio, str) and audio.startswith(("http://", "https://")):
+                audio_url = audio
+            else:
+                audio_url = await self.upload(audio)
+            transcript_id = await self.submit(audio_url)
+            result = await self.wait(transcript_id)
+        return {"text": result.get("text") or "", "language": result.get("language_code")}
+
+
+async def _read_file_chunks(path: str):
+    """Stream a file to httpx without blocking the loop on disk reads."""
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+# --- Local Whisper (runs inside the worker processes) ---
+_whisper_model = None
+
+
+def _whisper_init(model_size: str, compute_type: str, threads: int):
+    """Load the model once per worker process; every job in that worker reuses it."""
+    global _whisper_model
+    from faster_whisper import WhisperModel
+    _whisper_model = WhisperModel(model_size, device="cpu", compute_type=compute_type, cpu_threads=threads)
+
+
+def _whisper_transcribe(audio: bytes | str) -> dict:
+    source = audio if isinstance(audio, str) else io.BytesIO(audio)
+    segments, info = _whisper_model.transcribe(source, beam_size=1, vad_filter=True)
+    # segments is a lazy generator; joining it is what actually runs the decoder
+    text = " ".join(segment.text.strip() for segment in segments)
+    return {"text": text, "language": info.language}
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """
+    CPU transcription with faster-whisper in a process pool, so decoding runs
+    on other cores instead of the event loop. At most `workers` jobs run at
+    once and `queue_size` more may wait; beyond that jobs are rejected.
+    """
+
+    name = "whisper"
+
+    def __init__(self, model_size: str = WHISPER_MODEL_SIZE, compute_type: str = WHISPER_COMPUTE_TYPE,
+                 workers: int = WHISPER_WORKERS, threads: int = WHISPER_THREADS,
+                 queue_size: int = WHISPER_QUEUE_SIZE):
+        if importlib.util.find_spec("faster_whisper") is None:
+            raise RuntimeError("TRANSCRIPTION_BACKEND=whisper needs faster-whisper installed (pip install faster-whisper)")
+        self.model = model_size
+        self.compute_type = compute_type
+        self.workers = max(1, workers)
+        self.max_concurrency = self.workers
+        self.threads = threads
+        self.capacity = self.workers + max(0, queue_size)
+        self._pending = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Started lazily so processes that never transcribe never load the model
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=mp.get_context("spawn"),
+                initializer=_whisper_init,
+                initargs=(self.model, self.compute_type, self.threads),
+            )
+        return self._executor
+
+    async def transcribe(self, audio: bytes | bytearray | str) -> dict:
+        if isinstance(audio, str):
+            if not os.path.exists(audio):
+                raise TranscriptionError(f"File not found: {audio}")
+        else:
+            audio = bytes(audio)
+        if self._pending >= self.capacity:
+            metrics.incr("transcription.rejected")
+            raise TranscriptionError("Local transcription queue is full")
+
+        self._pending += 1
+        metrics.set_gauge("transcription.pending", self._pending)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool(), _whisper_transcribe, audio)
+        finally:
+            self._pending -= 1
+            metrics.set_gauge("transcription.pending", self._pending)
+
+    async def aclose(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def make_backend() -> TranscriptionBackend:
+    if TRANSCRIPTION_BACKEND == "whisper":
+        return LocalWhisperBackend()
+    return AssemblyAIClient()
+
+
+transcriber = make_backend()
+
+
+# === TRANSCRIPT CACHE ===
+# Values are JSON: {"text", "backend", "model", "language"}
+transcript_cache = TwoTierCache(
+    "transcript", table="transcript_cache",
+    maxsize=TRANSCRIPT_CACHE_SIZE, ttl=TRANSCRIPT_CACHE_TTL
+)
+
+
+def file_cache_key(file_unique_id: str) -> str:
+    """Telegram's file_unique_id is stable across forwards and re-sends of the same file."""
+    return content_key("transcript", "tg", file_unique_id)
+
+
+async def audio_cache_key(audio: bytes | bytearray | str) -> str:
+    """Content hash for audio that has no file_unique_id (or was re-uploaded as a new file)."""
+    if isinstance(audio, str):
+        def digest_file():
+            digest = hashlib.sha256()
+            with open(audio, "rb") as f:
+                for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            return digest.hexdigest()
+        digest = await asyncio.to_thread(digest_file)
+    else:
+        digest = hashlib.sha256(audio).hexdigest()
+    return content_key("transcript", "sha256", digest)
+
+
+async def get_cached_transcript(key: str) -> dict | None:
+    value = await transcript_cache.get(key)
+    return json.loads(value) if value is not None else None
+
+
+async def cache_transcript(keys: list[str], transcript: dict):
+    value = json.dumps(transcript)
+    for key in keys:
+        await transcript_cache.set(key, value)
+
+
+async def _preprocess_or_original(audio):
+    """Preprocessing only saves time; if it fails, transcribe the audio as received."""
+    from exec_report_audio_prep import preprocess
+    try:
+        return await preprocess(audio)
+    except Exception as e:
+        metrics.incr("audio_prep.failed")
+        print(f"⚠️ Audio preprocessing failed, using original audio: {e}")
+        return audio
+
+
+# === LONG AUDIO ===
+def chunk_concurrency(backend: TranscriptionBackend) -> int:
+    """Chunk jobs never take every backend slot, so short voice notes always get one."""
+    return max(1, min(LONG_AUDIO_CONCURRENCY, backend.max_concurrency - 1))
+
+
+# Shared by the chunks of every long recording in this process, not per recording
+_chunk_slots = asyncio.Semaphore(chunk_concurrency(transcriber))
+
+
+def _norm_word(word: str) -> str:
+    return re.sub(r"[^\w']", "", word).casefold()
+
+
+def join_overlapping(texts: list[str], max_words: int = MAX_OVERLAP_WORDS) -> str:
+    """
+    Join chunk transcripts, dropping the words each chunk repeats from the end
+    of the previous one (the longest match of at least two words, ignoring
+    case and punctuation).
+    """
+    joined: list[str] = []
+    for text in texts:
+        words = text.split()
+        if joined and words:
+            tail = [_norm_word(w) for w in joined[-max_words:]]
+            head = [_norm_word(w) for w in words[:max_words]]
+            for n in range(min(len(tail), len(head)), 1, -1):
+                if tail[-n:] == head[:n]:
+                    words = words[n:]
+                    break
+        joined.extend(words)
+    return " ".join(joined)
+
+
+async def _long_audio_chunks(audio) -> list[bytes] | None:
+    """Chunks for parallel transcription, or None to fall back to one job."""
+    try:
+        from exec_report_audio_prep import chunk_audio
+        chunks = await chunk_audio(audio, LONG_AUDIO_CHUNK_SECONDS, LONG_AUDIO_OVERLAP_SECONDS,
+                                   trim=AUDIO_PREPROCESS)
+    except Exception as e:
+        metrics.incr("transcription.chunking_failed")
+        print(f"⚠️ Could not split long audio, transcribing it in one piece: {e}")
+        return None
+    return chunks if len(chunks) > 1 else None
+
+
+async def transcribe_chunks(chunks: list[bytes], on_progress=None) -> dict:
+    """
+    Transcribe chunks concurrently within the shared chunk budget (see
+    chunk_concurrency) and join them in order. `on_progress(done, total)` is
+    awaited as chunks finish.
+    """
+    done = 0
+
+    async def run(chunk: bytes) -> dict:
+        nonlocal done
+        async with _chunk_slots:
+            result = await transcriber.transcribe(chunk)
+        done += 1
+        if on_progress:
+            await on_progress(done, len(chunks))
+        return result
+
+    results = await asyncio.gather(*(run(chunk) for chunk in chunks))
+    metrics.incr("transcription.chunks", len(chunks))
+    languages = Counter(r["language"] for r in results if r.get("language"))
+    return {
+        "text": join_overlapping([r["text"].strip() for r in results]),
+        "language": languages.most_common(1)[0][0] if languages else None,
+    }
+
+
+# === CACHED ENTRY POINT ===
+async def transcribe_cached(audio, file_unique_id: str | None = None, duration: int | None = None,
+                            on_progress=None) -> dict:
+    """
+    Transcript for `audio`, served from transcript_cache when the same content
+    was transcribed before. New results are cached under the content hash and,
+    when given, the Telegram file_unique_id. Recordings of LONG_AUDIO_MIN_SECONDS
+    or more are split and transcribed in parallel; otherwise, with
+    AUDIO_PREPROCESS on, the audio is trimmed and downsampled first.
+    """
+    keys = [await audio_cache_key(audio)]
+    cached = await get_cached_transcript(keys[0])
+    if file_unique_id:
+        keys.append(file_cache_key(file_unique_id))
+    if cached is not None:
+        if file_unique_id:
+            await transcript_cache.set(keys[1], json.dumps(cached))
+        return cached
+
+    chunks = None
+    if LONG_AUDIO_MIN_SECONDS and duration and duration >= LONG_AUDIO_MIN_SECONDS:
+        chunks = await _long_audio_chunks(audio)
+
+    with metrics.timed(f"transcription.{transcriber.name}"):
+        if chunks:
+            result = await transcribe_chunks(chunks, on_progress)
+        else:
+            if AUDIO_PREPROCESS:
+                audio = await _preprocess_or_original(audio)
+            result = await transcriber.transcribe(audio)
+
+    transcript = {
+        "text": result["text"].strip(),
+        "backend": transcriber.name,
+        "model": transcriber.model,
+        "language": result.get("language"),
+    }
+    await cache_transcript(keys, transcript)
+    return transcript
+
+
+# === BACKGROUND JOBS ===
+# Keep references so background jobs are not garbage-collected mid-flight
+_background_jobs: set[asyncio.Task] = set()
+
+
+def start_transcription(audio, on_text, on_error=None, cleanup=None, file_unique_id=None,
+                        duration=None, on_progress=None) -> asyncio.Task:
+    """
+    Transcribe in the background (via transcribe_cached) and hand the text to
+    `on_text` when ready. `on_error(exc)` is awaited if either step fails;
+    `cleanup()` always runs afterwards.
+    """
+
+    async def job():
+        try:
+            transcript = await transcribe_cached(audio, file_unique_id, duration, on_progress)
+            # on_text runs the whole update flow (Gemini, DB), so its failures count too
+            await on_text(transcript["text"])
+        except Exception as e:
+            print(f"Error in transcription job: {e}")
+            if on_error:
+                try:
+                    await on_error(e)
+                except Exception as reply_error:
+                    print(f"⚠️ Could not report transcription failure: {reply_error}")
+        finally:
+            if cleanup:
+                cleanup()
+
+    task = asyncio.create_task(job())
+    _background_jobs.add(task)
+    task.add_done_callback(_background_jobs.discard)
+    return task
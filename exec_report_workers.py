@@ -0,0 +1,214 @@
+import json
+import time
+import queue
+import asyncio
+import multiprocessing as mp
+
+from telegram import Bot, Update
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as WebApplication, RequestHandler
+
+from settings import (TELEGRAM_BOT_TOKEN, WEBHOOK_URL, PORT,
+                      WORKER_QUEUE_SIZE, WORKER_HEALTH_INTERVAL, init_db_pool)
+
+# Spawn, not fork: the ingress process already has a running event loop
+_mp = mp.get_context("spawn")
+
+
+# === SHARDING ===
+def extract_user_id(payload: dict) -> int | None:
+    """Find the acting user (or chat) id in a raw Telegram update."""
+    for key, value in payload.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if sender and "id" in sender:
+            return sender["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+    return None
+
+
+def shard_for(payload: dict, shards: int) -> int:
+    """Same user always lands on the same shard, so their updates stay in order."""
+    user_id = extract_user_id(payload)
+    return user_id % shards if user_id is not None else 0
+
+
+# === WORKER PROCESS ===
+def _worker_main(shard: int, inbox, status, build_application):
+    asyncio.run(_worker_loop(shard, inbox, status, build_application))
+
+
+async def _worker_loop(shard: int, inbox, status, build_application):
+    app = build_application()
+    await init_db_pool()
+    await app.initialize()
+    await app.start()
+    # PTB only runs these hooks inside run_polling/run_webhook
+    if app.post_init:
+        await app.post_init(app)
+    loop = asyncio.get_running_loop()
+    stats = {"shard": shard, "dispatched": 0, "errors": 0, "last_update_at": None}
+
+    async def heartbeat():
+        while True:
+            status.put({**stats, "pid": mp.current_process().pid, "sent_at": time.time()})
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    print(f"🧵 Shard {shard} worker ready.")
+
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, inbox.get)
+            if raw is None:
+                break
+            try:
+                update = Update.de_json(json.loads(raw), app.bot)
+                # Through the update queue so the app's update processor (and its ordering) applies
+                await app.update_queue.put(update)
+                stats["dispatched"] += 1
+            except Exception as e:
+                stats["errors"] += 1
+                print(f"⚠️ Shard {shard} failed to process update: {e}")
+            stats["last_update_at"] = time.time()
+    finally:
+        heartbeat_task.cancel()
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+
+# === INGRESS ===
+class ShardPool:
+    """Owns the worker processes, their inboxes and their last reported health."""
+
+    def __init__(self, build_application, shards: int):
+        self.build_application = build_application
+        self.shards = shards
+        self.inboxes = [_mp.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(shards)]
+        self.status = _mp.Queue()
+        self.processes: list = [None] * shards
+        self.health: dict[int, dict] = {}
+        self.restarts = [0] * shards
+
+    def start_worker(self, shard: int):
+        process = _mp.Process(
+            target=_worker_main,
+            args=(shard, self.inboxes[shard], self.status, self.build_application),
+            name=f"shard-{shard}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def start(self):
+        for shard in range(self.shards):
+            self.start_worker(shard)
+
+    def enqueue(self, raw: bytes) -> bool:
+        shard = shard_for(json.loads(raw), self.shards)
+        try:
+            self.inboxes[shard].put_nowait(raw)
+            return True
+        except queue.Full:
+            return False
+
+    def _drain_status(self):
+        """Consume queued heartbeats, keeping only the latest one per shard."""
+        while True:
+            try:
+                report = self.status.get_nowait()
+            except queue.Empty:
+                return
+            self.health[report["shard"]] = report
+
+    def report(self) -> dict:
+        self._drain_status()
+        now = time.time()
+        shards = []
+        for shard, process in enumerate(self.processes):
+            last = self.health.get(shard, {})
+            shards.append({
+                "shard": shard,
+                "alive": bool(process and process.is_alive()),
+                "pid": process.pid if process else None,
+                "queue_depth": self.inboxes[shard].qsize(),
+                "dispatched": last.get("dispatched", 0),
+                "errors": last.get("errors", 0),
+                "heartbeat_age_s": round(now - last["sent_at"], 1) if last else None,
+                "restarts": self.restarts[shard],
+            })
+        return {"shards": shards}
+
+    async def supervise(self):
+        """Restart any worker that died. Also drains heartbeats so the status queue stays small."""
+        while True:
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+            self._drain_status()
+            for shard, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    print(f"⚠️ Shard {shard} worker exited ({process.exitcode}), restarting...")
+                    self.restarts[shard] += 1
+                    self.start_worker(shard)
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=10)
+
+
+class WebhookHandler(RequestHandler):
+    def initialize(self, shards: ShardPool):
+        self.shards = shards
+
+    def post(self):
+        try:
+            accepted = self.shards.enqueue(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        # 503 makes Telegram redeliver later instead of us dropping the update
+        self.set_status(200 if accepted else 503)
+
+
+class HealthHandler(RequestHandler):
+    def initialize(self, shards: ShardPool):
+        self.shards = shards
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(self.shards.report()))
+
+
+async def run_ingress(build_application, shards: int, port: int = PORT):
+    """
+    Receive webhooks in this process and fan raw updates out to `shards`
+    worker processes, sharded by user_id. GET /health reports each shard.
+    """
+    pool = ShardPool(build_application, shards)
+    pool.start()
+
+    web = WebApplication([
+        (f"/{TELEGRAM_BOT_TOKEN}", WebhookHandler, {"shards": pool}),
+        (r"/health", HealthHandler, {"shards": pool}),
+    ])
+    server = HTTPServer(web)
+    server.listen(port, address="0.0.0.0")
+
+    async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+        await bot.delete_webhook()
+        await bot.set_webhook(WEBHOOK_URL)
+
+    print(f"🚀 Ingress listening on port {port} with {shards} shard workers...")
+
+    try:
+        await pool.supervise()
+    finally:
+        server.stop()
+        pool.stop()
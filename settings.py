@@ -2,34 +2,166 @@ import os
 from dotenv import load_dotenv
 
 import assemblyai as aai
-import asyncpg
+
+from exec_report_pool import InstrumentedPool
+from exec_report_queries import prepare_statements
 
 
 # === CONFIGURATION ===
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
-pool: asyncpg.pool.Pool = None
+# Connection pool sizing and behaviour
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 5))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30)) or None
+# Warn when waiting for a connection takes longer than this
+DB_ACQUIRE_WARN_MS = float(os.getenv("DB_ACQUIRE_WARN_MS", 200))
+# Adaptive mode: allow up to DB_POOL_ADAPTIVE_MAX connections after DB_POOL_ADAPTIVE_STREAK slow acquires in a row
+DB_POOL_ADAPTIVE = os.getenv("DB_POOL_ADAPTIVE", "0").lower() in ("1", "true", "yes")
+DB_POOL_ADAPTIVE_MAX = int(os.getenv("DB_POOL_ADAPTIVE_MAX", 20))
+DB_POOL_ADAPTIVE_STREAK = int(os.getenv("DB_POOL_ADAPTIVE_STREAK", 5))
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 WEBHOOK_URL = f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME')}/{TELEGRAM_BOT_TOKEN}"
 PORT = int(os.getenv("PORT", 8080))
+# Shard worker processes behind one webhook ingress ("auto" = one per core, 0 = single process)
+_workers = os.getenv("WORKER_PROCESSES", "0")
+WORKER_PROCESSES = (os.cpu_count() or 1) if _workers == "auto" else int(_workers)
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 1000))
+WORKER_HEALTH_INTERVAL = float(os.getenv("WORKER_HEALTH_INTERVAL", 5))
+# Concurrent update handling: handlers running at once across chats (0 = one update at a time),
+# and max updates admitted including those waiting behind their chat
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 0))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", 256))
 
 # Read admin IDs from .env and split into a list of integers
 DEV_USER_IDS = [int(x) for x in os.getenv("DEV_USER_IDS", "").split(",") if x]
 ADMIN_USER_IDS = [int(x.strip()) for x in os.getenv("TELEGRAM_ADMIN_IDS", "").split(",") if x.strip()]
 EXEC_IDS = [int(x) for x in os.getenv("EXEC_IDS", "").split(",") if x]
+# Role cache: seconds before a user's org roles are re-read, and max users kept
+ROLE_CACHE_TTL = float(os.getenv("ROLE_CACHE_TTL", 300))
+ROLE_CACHE_SIZE = int(os.getenv("ROLE_CACHE_SIZE", 4096))
+# Sessions: seconds a local copy of user_data is trusted before re-reading Postgres,
+# and how often changed user/conversation data is flushed
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 5))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", 1))
+# Write-behind telemetry (visits etc.): max buffered rows, batch size and max seconds between flushes
+TELEMETRY_BUFFER_SIZE = int(os.getenv("TELEMETRY_BUFFER_SIZE", 10000))
+TELEMETRY_FLUSH_SIZE = int(os.getenv("TELEMETRY_FLUSH_SIZE", 500))
+TELEMETRY_FLUSH_INTERVAL = float(os.getenv("TELEMETRY_FLUSH_INTERVAL", 5))
+# Updates shown per page of the "Recent Updates" feed
+FEED_PAGE_SIZE = int(os.getenv("FEED_PAGE_SIZE", 5))
+# "single": one message per update; "bulk": photo albums + packed text messages
+FEED_DELIVERY_MODE = os.getenv("FEED_DELIVERY_MODE", "single").lower()
+# Results shown per page of /search
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 5))
+# Newest bullets kept per section in each daily/weekly org rollup
+ROLLUP_MAX_BULLETS = int(os.getenv("ROLLUP_MAX_BULLETS", 20))
+# Media store for update images: "local" (sharded dirs under MEDIA_ROOT) or "s3" (any S3-compatible endpoint)
+MEDIA_BACKEND = os.getenv("MEDIA_BACKEND", "local").lower()
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "media")
+MEDIA_S3_BUCKET = os.getenv("MEDIA_S3_BUCKET")
+MEDIA_S3_PREFIX = os.getenv("MEDIA_S3_PREFIX", "")
+MEDIA_S3_ENDPOINT_URL = os.getenv("MEDIA_S3_ENDPOINT_URL") or None
+MEDIA_S3_REGION = os.getenv("MEDIA_S3_REGION") or None
+# Incoming media is downloaded into memory; files above MEDIA_SPILL_THRESHOLD bytes, or arriving
+# while MEDIA_MEMORY_CAP bytes are already held in flight, go to a temp file under MEDIA_SPILL_DIR
+MEDIA_SPILL_THRESHOLD = int(os.getenv("MEDIA_SPILL_THRESHOLD", 8 * 1024 * 1024))
+MEDIA_MEMORY_CAP = int(os.getenv("MEDIA_MEMORY_CAP", 64 * 1024 * 1024))
+MEDIA_SPILL_DIR = os.getenv("MEDIA_SPILL_DIR") or None
+# "Similar past incidents": per-org hashed TF-IDF index files under SIMILARITY_DIR, hash buckets per
+# vector, matches shown, and the minimum cosine score for a match
+SIMILARITY_DIR = os.getenv("SIMILARITY_DIR", "similarity")
+SIMILARITY_DIM = int(os.getenv("SIMILARITY_DIM", 2048))
+SIMILARITY_TOP_K = int(os.getenv("SIMILARITY_TOP_K", 5))
+SIMILARITY_MIN_SCORE = float(os.getenv("SIMILARITY_MIN_SCORE", 0.2))
+# /export: rows fetched per chunk, max seconds for one export, and where temp files go (system temp dir if unset)
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 5000))
+EXPORT_TIMEOUT = float(os.getenv("EXPORT_TIMEOUT", 600))
+EXPORT_DIR = os.getenv("EXPORT_DIR") or None
+# Outbound Telegram pacing: global msgs/s, per private chat msgs/s (+ burst), per group msgs/min
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 30))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", 5))
+OUTBOUND_GROUP_RATE_PER_MIN = float(os.getenv("OUTBOUND_GROUP_RATE_PER_MIN", 20))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", 3))
+# Optional audio preprocessing before transcription (needs ffmpeg + numpy): downmix to 16 kHz mono,
+# trim silence with an energy VAD, and re-encode as Opus at AUDIO_OPUS_BITRATE
+AUDIO_PREPROCESS = os.getenv("AUDIO_PREPROCESS", "0").lower() in ("1", "true", "yes")
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+AUDIO_OPUS_BITRATE = os.getenv("AUDIO_OPUS_BITRATE", "24k")
+# VAD: frame length, frames quieter than THRESHOLD_DB (dBFS) are silence; silences longer than
+# MAX_SILENCE_MS are shortened to it, and PAD_MS is kept around speech at the start and end
+AUDIO_VAD_FRAME_MS = int(os.getenv("AUDIO_VAD_FRAME_MS", 30))
+AUDIO_VAD_THRESHOLD_DB = float(os.getenv("AUDIO_VAD_THRESHOLD_DB", -40))
+AUDIO_MAX_SILENCE_MS = int(os.getenv("AUDIO_MAX_SILENCE_MS", 600))
+AUDIO_VAD_PAD_MS = int(os.getenv("AUDIO_VAD_PAD_MS", 200))
 # Allowed audio file extensions
 SUPPORTED_FORMATS = {".mp3", ".wav", ".m4a", ".flac", ".ogg", ".webm"}
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+# Max Gemini calls in flight per process, and per-call timeout in seconds
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 4))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", 30))
+# Micro-batching: collect updates for this many ms into one Gemini call (0 disables)
+GEMINI_BATCH_WINDOW_MS = int(os.getenv("GEMINI_BATCH_WINDOW_MS", 0))
+GEMINI_BATCH_MAX_ITEMS = int(os.getenv("GEMINI_BATCH_MAX_ITEMS", 8))
+# Structured-update cache: in-memory LRU entries and TTL (seconds) for both tiers
+STRUCTURED_CACHE_SIZE = int(os.getenv("STRUCTURED_CACHE_SIZE", 1024))
+STRUCTURED_CACHE_TTL = float(os.getenv("STRUCTURED_CACHE_TTL", 86400))
 aai.settings.api_key = os.getenv("ASSEMBLYAI_API_KEY")
 ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
+# Point at a local stand-in server for testing
+ASSEMBLYAI_BASE_URL = os.getenv("ASSEMBLYAI_BASE_URL", "https://api.assemblyai.com")
+ASSEMBLYAI_MAX_CONCURRENCY = int(os.getenv("ASSEMBLYAI_MAX_CONCURRENCY", 4))
+# Poll backoff starts at POLL_INTERVAL seconds and grows to POLL_MAX_INTERVAL
+ASSEMBLYAI_POLL_INTERVAL = float(os.getenv("ASSEMBLYAI_POLL_INTERVAL", 1.0))
+ASSEMBLYAI_POLL_MAX_INTERVAL = float(os.getenv("ASSEMBLYAI_POLL_MAX_INTERVAL", 10.0))
+ASSEMBLYAI_TIMEOUT = float(os.getenv("ASSEMBLYAI_TIMEOUT", 600))
+# Transcript cache (keyed by Telegram file_unique_id or audio hash): in-memory LRU entries and TTL (seconds)
+TRANSCRIPT_CACHE_SIZE = int(os.getenv("TRANSCRIPT_CACHE_SIZE", 2048))
+TRANSCRIPT_CACHE_TTL = float(os.getenv("TRANSCRIPT_CACHE_TTL", 30 * 86400))
+# Long recordings (at least LONG_AUDIO_MIN_SECONDS; 0 disables, needs ffmpeg + numpy) are split at pauses
+# into ~LONG_AUDIO_CHUNK_SECONDS chunks overlapping by LONG_AUDIO_OVERLAP_SECONDS; at most
+# LONG_AUDIO_CONCURRENCY chunks (across all recordings, and always one fewer than the backend's
+# own concurrency) are transcribed at once
+LONG_AUDIO_MIN_SECONDS = int(os.getenv("LONG_AUDIO_MIN_SECONDS", 0))
+LONG_AUDIO_CHUNK_SECONDS = float(os.getenv("LONG_AUDIO_CHUNK_SECONDS", 120))
+LONG_AUDIO_OVERLAP_SECONDS = float(os.getenv("LONG_AUDIO_OVERLAP_SECONDS", 2))
+LONG_AUDIO_CONCURRENCY = int(os.getenv("LONG_AUDIO_CONCURRENCY", 4))
+# Transcription backend: "assemblyai" (hosted) or "whisper" (local faster-whisper on CPU)
+TRANSCRIPTION_BACKEND = os.getenv("TRANSCRIPTION_BACKEND", "assemblyai").lower()
+# Local Whisper: model size ("tiny", "base", "small", "medium", "large-v3"), CTranslate2 compute type,
+# worker processes (each loads the model once), CPU threads per worker, and max jobs waiting for a worker
+WHISPER_MODEL_SIZE = os.getenv("WHISPER_MODEL_SIZE", "small")
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+WHISPER_WORKERS = int(os.getenv("WHISPER_WORKERS", 2))
+WHISPER_THREADS = int(os.getenv("WHISPER_THREADS", 0))
+WHISPER_QUEUE_SIZE = int(os.getenv("WHISPER_QUEUE_SIZE", 16))
 
 
 # Connection Factory
+# Created unconnected at import so `from settings import pool` is always the live object
+pool = InstrumentedPool(
+    DATABASE_URL,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    max_inactive_lifetime=DB_MAX_INACTIVE_LIFETIME,
+    command_timeout=DB_COMMAND_TIMEOUT,
+    warn_ms=DB_ACQUIRE_WARN_MS,
+    adaptive=DB_POOL_ADAPTIVE,
+    adaptive_max=DB_POOL_ADAPTIVE_MAX,
+    adaptive_streak=DB_POOL_ADAPTIVE_STREAK,
+    # Every new connection checks the hot statements from the query registry
+    init=prepare_statements,
+)
+
+
 async def init_db_pool():
-    global pool
-    if pool is None:
-        pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+    if not pool.connected:
+        await pool.connect()
     return pool
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""Query registry calls on a pooled connection that is checked out more than once."""
+import asyncio
+
+import asyncpg
+
+import exec_report_queries as queries
+from exec_report_pool import InstrumentedPool
+
+
+class FakeConnection:
+    """
+    Mimics asyncpg's checkout guard: prepared-statement handles remember the
+    release counter they were created under and refuse to run after a release.
+    """
+
+    def __init__(self):
+        self.release_ctr = 0
+        self.executed = []
+
+    async def prepare(self, sql):
+        return FakeStatement(self, sql)
+
+    async def fetch(self, sql, *args):
+        self.executed.append((sql, args))
+        return [{"org_id": 1}]
+
+    async def fetchrow(self, sql, *args):
+        return (await self.fetch(sql, *args))[0]
+
+
+class FakeStatement:
+    def __init__(self, conn, sql):
+        self.conn = conn
+        self.sql = sql
+        self.ctr = conn.release_ctr
+
+    async def fetch(self, *args):
+        if self.ctr != self.conn.release_ctr:
+            raise asyncpg.InterfaceError("the underlying connection has been released back to the pool")
+        return await self.conn.fetch(self.sql, *args)
+
+
+class FakePool:
+    """One connection, handed out on every acquire."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def acquire(self, timeout=None):
+        return self.conn
+
+    async def release(self, conn):
+        conn.release_ctr += 1
+
+    def get_size(self):
+        return 1
+
+    def get_idle_size(self):
+        return 1
+
+
+def test_registry_query_works_on_every_checkout_of_a_connection():
+    conn = FakeConnection()
+    pool = InstrumentedPool("postgres://unused", 1, 1, 100, 300, None, 200, init=queries.prepare_statements)
+    pool._pool = FakePool(conn)
+
+    async def run():
+        await queries.prepare_statements(conn)
+        results = []
+        for _ in range(2):
+            async with pool.acquire() as checked_out:
+                assert checked_out is conn
+                results.append(await queries.fetch(checked_out, "user_org_ids", 42))
+        return results
+
+    assert asyncio.run(run()) == [[{"org_id": 1}], [{"org_id": 1}]]
+    assert conn.release_ctr == 2
+    assert conn.executed == [(queries.QUERIES["user_org_ids"], (42,))] * 2
@@ -0,0 +1,154 @@
+"""AssemblyAIClient against a local stand-in for the AssemblyAI API (ASSEMBLYAI_BASE_URL)."""
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import exec_report_transcription as transcription
+from exec_report_transcription import AssemblyAIClient, TranscriptionError
+
+
+class FakeAssemblyAI:
+    """
+    Minimal /v2/upload, /v2/transcript and /v2/transcript/<id> server.
+    `statuses` is what successive polls return; the last one repeats.
+    """
+
+    def __init__(self, statuses, upload_status=200):
+        self.statuses = list(statuses)
+        self.upload_status = upload_status
+        self.uploads = []
+        self.submissions = []
+        self.polls = []
+        self.auth_headers = set()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def do_POST(self):
+                fake.auth_headers.add(self.headers.get("authorization"))
+                if self.path == "/v2/upload":
+                    fake.uploads.append(self._body())
+                    if fake.upload_status != 200:
+                        self._reply(fake.upload_status, {"error": "upload failed"})
+                    else:
+                        self._reply(200, {"upload_url": "https://cdn.example/audio-1"})
+                elif self.path == "/v2/transcript":
+                    fake.submissions.append(json.loads(self._body()))
+                    self._reply(200, {"id": "t-1", "status": "queued"})
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_GET(self):
+                if self.path != "/v2/transcript/t-1":
+                    self._reply(404, {"error": "not found"})
+                    return
+                fake.polls.append(time.monotonic())
+                index = min(len(fake.polls), len(fake.statuses)) - 1
+                self._reply(200, fake.statuses[index])
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def transcribe(fake, audio, **kwargs):
+    async def run():
+        client = AssemblyAIClient(api_key="test-key", base_url=fake.base_url, **kwargs)
+        try:
+            return await client.transcribe(audio)
+        finally:
+            await client.aclose()
+    return asyncio.run(run())
+
+
+def test_upload_submit_and_poll_until_completed():
+    statuses = [
+        {"status": "queued"},
+        {"status": "processing"},
+        {"status": "completed", "text": "Shipment delayed at customs.", "language_code": "en"},
+    ]
+    with FakeAssemblyAI(statuses) as fake:
+        result = transcribe(fake, b"fake-ogg-bytes", poll_interval=0.01, poll_max_interval=0.05, timeout=5)
+
+    assert result == {"text": "Shipment delayed at customs.", "language": "en"}
+    assert fake.uploads == [b"fake-ogg-bytes"]
+    assert fake.submissions == [{"audio_url": "https://cdn.example/audio-1", "speech_model": "universal"}]
+    assert len(fake.polls) == 3
+    assert fake.auth_headers == {"test-key"}
+
+
+def test_poll_interval_backs_off_up_to_the_cap(monkeypatch):
+    delays = []
+    real_sleep = asyncio.sleep
+
+    async def record_sleep(delay, *args, **kwargs):
+        # Zero-length sleeps are event-loop checkpoints from the HTTP stack, not poll waits
+        if delay > 0:
+            delays.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(transcription.asyncio, "sleep", record_sleep)
+    statuses = [{"status": "processing"}] * 5 + [{"status": "completed", "text": "ok"}]
+    with FakeAssemblyAI(statuses) as fake:
+        transcribe(fake, b"audio", poll_interval=0.05, poll_max_interval=0.1, timeout=5)
+
+    assert delays == pytest.approx([0.05, 0.075, 0.1, 0.1, 0.1])
+
+
+def test_failed_transcript_raises():
+    statuses = [{"status": "processing"}, {"status": "error", "error": "Audio file is corrupt"}]
+    with FakeAssemblyAI(statuses) as fake:
+        with pytest.raises(TranscriptionError, match="corrupt"):
+            transcribe(fake, b"audio", poll_interval=0.01, timeout=5)
+
+
+def test_poll_timeout_raises():
+    with FakeAssemblyAI([{"status": "processing"}]) as fake:
+        with pytest.raises(TranscriptionError, match="timed out"):
+            transcribe(fake, b"audio", poll_interval=0.02, poll_max_interval=0.02, timeout=0.1)
+
+
+def test_upload_http_error_is_raised():
+    with FakeAssemblyAI([{"status": "completed", "text": ""}], upload_status=500) as fake:
+        with pytest.raises(httpx.HTTPStatusError):
+            transcribe(fake, b"audio")
+    assert fake.submissions == []
+
+
+def test_unsupported_local_file_is_rejected(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("not audio")
+    with FakeAssemblyAI([{"status": "completed", "text": ""}]) as fake:
+        with pytest.raises(TranscriptionError, match="Unsupported file type"):
+            transcribe(fake, str(path))
+    assert fake.uploads == []